@@ -0,0 +1,229 @@
+"""
+Benchmarks for filter_visualization on seeded synthetic event logs.
+
+Times every stage (lineage lookup, case metrics, tree build, pie and icicle)
+on a generated log, tracks the peak memory of each stage, and can store the
+results as a baseline or check them against one:
+
+    python benchmark.py --cases 30000 --depth 5 --save benchmark_baseline.json
+    python benchmark.py --cases 30000 --depth 5 --compare benchmark_baseline.json
+
+Needs logview on the path, but no network access or BPI data.
+"""
+import argparse
+import io
+import json
+import sys
+import time
+from contextlib import redirect_stdout
+
+import numpy as np
+import pandas as pd
+import plotly.io as pio
+
+import filter_visualization as fv
+
+ACTIVITY_PREFIXES = ["A_", "O_", "W_"]
+
+def generate_event_log(num_cases=10000, events_per_case=10, attribute_cardinality=8, seed=0):
+    """
+    Seeded synthetic event log in the pm4py column layout. Case lengths are
+    uniform around events_per_case, and attribute_cardinality sets the number
+    of distinct activities and of values of the categorical case attributes.
+    """
+    rng = np.random.default_rng(seed)
+
+    case_lengths = rng.integers(1, 2 * events_per_case, num_cases)
+    num_events = int(case_lengths.sum())
+    case_of_event = np.repeat(np.arange(num_cases), case_lengths)
+    case_starts = np.concatenate([[0], np.cumsum(case_lengths)[:-1]])
+
+    # Timestamps: a random case start plus exponential gaps of a few hours
+    gaps = rng.exponential(4 * 3600, num_events).astype(np.int64)
+    gaps[case_starts] = 0
+    offsets = np.cumsum(gaps)
+    offsets -= np.repeat(offsets[case_starts], case_lengths)
+    starts = rng.integers(0, 365 * 86400, num_cases)
+    timestamps = pd.Timestamp("2016-01-01") + pd.to_timedelta(np.repeat(starts, case_lengths) + offsets, unit="s")
+
+    activities = np.array([
+        f"{ACTIVITY_PREFIXES[i % len(ACTIVITY_PREFIXES)]}Activity{i}" for i in range(attribute_cardinality)
+    ])
+    application_types = np.array([f"Type{i}" for i in range(attribute_cardinality)])
+    loan_goals = np.array([f"Goal{i}" for i in range(attribute_cardinality)])
+
+    return pd.DataFrame({
+        "case:concept:name": np.char.add("Application_", case_of_event.astype(str)),
+        "concept:name": activities[rng.integers(0, attribute_cardinality, num_events)],
+        "time:timestamp": timestamps,
+        "RequestedAmount": np.repeat(rng.integers(500, 50000, num_cases), case_lengths),
+        "CreditScore": np.repeat(rng.integers(0, 1000, num_cases), case_lengths),
+        "ApplicationType": np.repeat(application_types[rng.integers(0, attribute_cardinality, num_cases)], case_lengths),
+        "LoanGoal": np.repeat(loan_goals[rng.integers(0, attribute_cardinality, num_cases)], case_lengths)
+    })
+
+def lineage_queries(log, depth, seed=0):
+    """
+    depth queries cycling through the EqToConstant, GreaterEqualToConstant,
+    StartWith, EndWith and DurationWithin predicates, with constants drawn
+    from the log so that every step splits the cases.
+    """
+    from logview.predicate import Query, EqToConstant, GreaterEqualToConstant, StartWith, EndWith, DurationWithin
+
+    rng = np.random.default_rng(seed)
+    activities = log["concept:name"].unique()
+    durations = fv.compute_case_metrics(log)["case_duration"]
+
+    def make_query(step):
+        kind = step % 5
+        if kind == 0:
+            value = rng.choice(log["ApplicationType"].unique())
+            return Query(f"Type{step}", [EqToConstant("ApplicationType", value)])
+        if kind == 1:
+            threshold = int(log["RequestedAmount"].quantile(rng.uniform(0.3, 0.7)))
+            return Query(f"Amount{step}", [GreaterEqualToConstant("RequestedAmount", threshold)])
+        if kind == 2:
+            return Query(f"Start{step}", [StartWith(list(rng.choice(activities, max(len(activities) // 2, 1), replace=False)))])
+        if kind == 3:
+            return Query(f"End{step}", [EndWith(list(rng.choice(activities, max(len(activities) // 2, 1), replace=False)))])
+        low, high = durations.quantile([0.2, 0.8])
+        return Query(f"Duration{step}", [DurationWithin(int(low), int(high))])
+
+    return [make_query(step) for step in range(depth)]
+
+def build_log_view(log, depth, seed=0):
+    """
+    Log view with a chain of depth result sets on the log. Returns the log
+    view and the name of the last result set.
+    """
+    from logview.utils import LogViewBuilder
+
+    log_view = LogViewBuilder.build_log_view(log)
+    source = log
+    result_set_name = None
+    for step, query in enumerate(lineage_queries(log, depth, seed)):
+        result_set_name = f"rs_step{step + 1}"
+        source, _ = log_view.evaluate_query(result_set_name, source, query)
+    return log_view, result_set_name
+
+def run_stage(func, repeat):
+    """
+    Best wall time over repeat cold runs, and the peak memory of one more.
+    """
+    timings = []
+    for _ in range(repeat):
+        fv.clear_caches()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    fv.clear_caches()
+    with fv.PeakMemory() as memory:
+        func()
+
+    return {"seconds": min(timings), "peak_mib": memory.peak_bytes / 1024 ** 2}
+
+def run_benchmarks(num_cases, events_per_case, attribute_cardinality, depth, seed=0, repeat=3, n_jobs=1,
+                   backend="pandas"):
+    fv.set_backend(backend)
+    log = generate_event_log(num_cases, events_per_case, attribute_cardinality, seed)
+    log_view, result_set_name = build_log_view(log, depth, seed)
+    lineage = fv.get_query_catalog(log_view).lineage(result_set_name)
+
+    def quietly(func, *args, **kwargs):
+        with redirect_stdout(io.StringIO()):
+            func(*args, **kwargs)
+
+    stages = {
+        "get_lineage": lambda: fv.get_lineage(log_view.query_registry.summary(), result_set_name),
+        "query_catalog_lineage": lambda: fv.get_query_catalog(log_view).lineage(result_set_name),
+        "case_metrics": lambda: fv.compute_case_metrics(log),
+        "recursively_apply_filters": lambda: fv.recursively_apply_filters(
+            lineage, log_view, "avg_case_duration_seconds", n_jobs=n_jobs
+        ),
+        "query_breakdown_pie": lambda: quietly(
+            fv.query_breakdown_pie, result_set_name, log_view, details=True, n_jobs=n_jobs
+        ),
+        "query_exploration_icicle": lambda: quietly(
+            fv.query_exploration_icicle, result_set_name, log_view, details=True, n_jobs=n_jobs
+        )
+    }
+
+    return {
+        "config": {
+            "num_cases": num_cases,
+            "events_per_case": events_per_case,
+            "attribute_cardinality": attribute_cardinality,
+            "depth": depth,
+            "seed": seed,
+            "n_jobs": n_jobs,
+            "backend": backend,
+            "num_events": len(log)
+        },
+        "stages": {name: run_stage(func, repeat) for name, func in stages.items()}
+    }
+
+# Differences below these are noise, whatever the relative tolerance
+ABSOLUTE_SLACK = {"seconds": 0.005, "peak_mib": 0.5}
+
+def compare_to_baseline(results, baseline, tolerance=0.25):
+    """
+    Stages whose time or peak memory exceeds the baseline by more than the
+    tolerance, as (stage, measure, baseline value, current value) tuples.
+    """
+    if baseline["config"] != results["config"]:
+        raise ValueError("The baseline was recorded with a different configuration.")
+
+    regressions = []
+    for stage, measures in results["stages"].items():
+        stored = baseline["stages"].get(stage)
+        if stored is None:
+            continue
+        for measure, value in measures.items():
+            if value > stored[measure] * (1 + tolerance) + ABSOLUTE_SLACK[measure]:
+                regressions.append((stage, measure, stored[measure], value))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark filter_visualization on a synthetic event log.")
+    parser.add_argument("--cases", type=int, default=10000)
+    parser.add_argument("--events-per-case", type=int, default=10)
+    parser.add_argument("--cardinality", type=int, default=8)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument("--backend", choices=fv.BACKENDS, default="pandas")
+    parser.add_argument("--save", metavar="PATH", help="store the results as a baseline")
+    parser.add_argument("--compare", metavar="PATH", help="fail on regressions against a stored baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    # Never open a browser or notebook output for the figures
+    pio.renderers.default = ""
+
+    results = run_benchmarks(
+        args.cases, args.events_per_case, args.cardinality, args.depth,
+        seed=args.seed, repeat=args.repeat, n_jobs=args.n_jobs, backend=args.backend
+    )
+
+    print(f"{results['config']['num_events']:,} events, {args.cases:,} cases, depth {args.depth}\n")
+    for stage, measures in results["stages"].items():
+        print(f"{stage:28}: {measures['seconds']:8.4f} s  {measures['peak_mib']:9.2f} MiB")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        for stage, measure, stored, value in regressions:
+            print(f"REGRESSION {stage} {measure}: {stored:.4f} -> {value:.4f}")
+        if regressions:
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,41 @@
 import pandas as pd
-import pm4py
-from logview.utils import LogViewBuilder
-from logview.predicate import Query, EqToConstant, NotEqToConstant, GreaterEqualToConstant, LessThanConstant, StartWith, EndWith, DurationWithin
-import plotly.express as px
 import time
-from datetime import timedelta
-import string
-import plotly.graph_objects as go
-from plotly.colors import sample_colorscale
 import numpy as np
+import weakref
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import tracemalloc
+import contextlib
+import contextvars
+import json
+import argparse
+import copy
+import itertools
+import multiprocessing
+import operator
+import threading
+from concurrent.futures import CancelledError, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+import shutil
+import sys
+
+def _trace_lineage(evaluations_by_result_set, result_set_name):
+    lineage_rows = []
+    visited = set()
+    current_result_set = result_set_name
+
+    while current_result_set in evaluations_by_result_set:
+        if current_result_set in visited:
+            raise ValueError(f"Cycle in the lineage of '{result_set_name}' at '{current_result_set}'.")
+        visited.add(current_result_set)
+        row = evaluations_by_result_set[current_result_set]
+        lineage_rows.append(row)
+        current_result_set = row['source_log']
+
+    # Reverse the result to show forward lineage
+    return pd.DataFrame(lineage_rows[::-1])
 
 def get_lineage(registry, result_set_name):
     """
@@ -16,141 +43,691 @@ def get_lineage(registry, result_set_name):
     showing the lineage of how that result_set was derived.
     """
     evaluations = registry['evaluations']
-    
-    lineage_rows = []
+    evaluations_by_result_set = {row['result_set']: row for _, row in evaluations.iterrows()}
+    return _trace_lineage(evaluations_by_result_set, result_set_name)
 
-    def trace_back(current_result_set):
+class QueryCatalog:
+    """
+    Index over the query registry of a log_view. Maps every result set to its
+    source log, evaluation row and query, and every query name to its query
+    object and expression. New and replaced registrations are picked up on
+    refresh().
+    """
+
+    def __init__(self, query_registry):
+        self.query_registry = query_registry
+        self._reset()
+
+    def _reset(self):
+        self.evaluations = {}
+        self.parents = {}
+        self.result_set_queries = {}
+        self.query_map = {}
+        self.query_expression_map = {}
+        self._indexed_ids = []
+
+    def _is_replaced(self, result_set_ids):
+        # A result set registered again under the same id comes with a new query object
+        num_known = len(self._indexed_ids)
+        return result_set_ids[:num_known] != self._indexed_ids or any(
+            self.query_registry.get_evaluation(result_set_id)["query"] is not self.result_set_queries[result_set_id]
+            for result_set_id in self._indexed_ids
+        )
+
+    def refresh(self):
+        result_set_ids = list(self.query_registry.get_registered_result_set_ids())
+        replaced = self._is_replaced(result_set_ids)
+        if not replaced and result_set_ids == self._indexed_ids:
+            return self
+
+        # Re-index everything if a registration was replaced, otherwise only the new ones
+        num_known = len(self._indexed_ids)
+        if replaced:
+            self._reset()
+            num_known = 0
+        new_ids = result_set_ids[num_known:]
+
+        evaluations = self.query_registry.summary()['evaluations']
+        new_id_set = set(new_ids)
         for _, row in evaluations.iterrows():
-            if row['result_set'] == current_result_set:
-                lineage_rows.append(row)
-                trace_back(row['source_log'])
+            if row['result_set'] in new_id_set:
+                self.evaluations[row['result_set']] = row
+                self.parents[row['result_set']] = row['source_log']
+
+        for result_set_id in new_ids:
+            query_obj = self.query_registry.get_evaluation(result_set_id)["query"]
+            self.result_set_queries[result_set_id] = query_obj
+            self.query_map[query_obj.name] = query_obj
+            self.query_expression_map[query_obj.name] = _query_expression(query_obj)
+
+        self._indexed_ids = result_set_ids
+        return self
+
+    def lineage(self, result_set_name):
+        """
+        Forward lineage of a result set, as returned by get_lineage().
+        """
+        return _trace_lineage(self.evaluations, result_set_name)
+
+    def query_for(self, lineage_row):
+        """
+        Query object that produced a lineage row, falling back to a lookup by
+        query name.
+        """
+        query_obj = self.result_set_queries.get(lineage_row["result_set"])
+        if query_obj is None:
+            query_obj = self.query_map.get(lineage_row["query"])
+        return query_obj
+
+    def expression_for(self, lineage_row):
+        """
+        Expression of the query that produced a lineage row, None when that
+        query is unknown. Unlike query_expression_map, which is keyed by query
+        name, this tells apart queries registered under the same name.
+        """
+        query_obj = self.query_for(lineage_row)
+        return None if query_obj is None else _query_expression(query_obj)
+
+# Per-object state (case metric tables, query catalogs) keyed by id() of the
+# object it belongs to, dropped as soon as that object is garbage collected
+def _get_attached(cache, owner):
+    entry = cache.get(id(owner))
+    if entry is not None and entry[0]() is owner and (entry[2] is None or _is_unchanged(owner, entry[2])):
+        return entry[1]
+    return None
+
+def _attach(cache, owner, value):
+    key = id(owner)
+    snapshot = _frame_snapshot(owner) if isinstance(owner, pd.DataFrame) else None
+    cache[key] = (weakref.ref(owner, lambda _, key=key: cache.pop(key, None)), value, snapshot)
+    return value
+
+# State attached to a DataFrame also holds its columns. Under copy-on-write (the
+# pandas default from 3.0) an in-place edit of a column referenced elsewhere first
+# gives the frame a fresh copy of that column, so edited frames are told apart by
+# their columns no longer sharing values with the ones held here.
+def _copy_on_write():
+    # pandas 3 always copies on write, pandas 2 only with the copy_on_write option set
+    if int(pd.__version__.split(".")[0]) >= 3:
+        return True
+    return pd.get_option("mode.copy_on_write") is True
+
+def _content_digest(df):
+    return hashlib.blake2b(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes(), digest_size=16).digest()
+
+def _frame_snapshot(df):
+    # Under copy-on-write an in-place edit replaces the edited column's values,
+    # which the held columns detect. Without it values can change in place, so
+    # their content is hashed as well, at the cost of a pass over the log.
+    return list(df.items()), None if _copy_on_write() else _content_digest(df)
+
+def _same_values(a, b):
+    # Whether two columns share their values, checked without copying them
+    if a.dtype != b.dtype or len(a) != len(b):
+        return False
+    x, y = a.array, b.array
+    if x is y:
+        return True
+    if isinstance(a.dtype, pd.CategoricalDtype):
+        x, y = x.codes, y.codes
+    elif hasattr(x, "asi8"):
+        x, y = x.asi8, y.asi8
+    elif isinstance(x, pd.arrays.NumpyExtensionArray):
+        x, y = x.to_numpy(), y.to_numpy()
+    else:
+        return False
+    return x.__array_interface__["data"][0] == y.__array_interface__["data"][0]
 
-    trace_back(result_set_name)
-    
-    # Reverse the result to show forward lineage
-    lineage_df = pd.DataFrame(lineage_rows[::-1])
-    return lineage_df
+def _is_unchanged(df, snapshot):
+    columns, digest = snapshot
+    return len(df.columns) == len(columns) and all(
+        name == held_name and _same_values(column, held)
+        for (name, column), (held_name, held) in zip(df.items(), columns)
+    ) and (digest is None or _content_digest(df) == digest)
+
+_query_catalogs = {}
+
+# Held while the caches below are looked up and updated, so chart builds on a
+# ChartJob thread and calls from the caller's thread do not corrupt them.
+# Trees and breakdowns are computed outside of it; two threads missing the
+# same entry may both compute it and the last one is kept.
+_cache_lock = threading.RLock()
+
+def clear_caches():
+    """
+    Drop every in-memory case metric table, case table, log fingerprint,
+    query catalog, filter tree, pie breakdown, case sample, event store and
+    session cache. The disk cache, if enabled, is left alone.
+    """
+    with _cache_lock:
+        for cache in (_case_metrics_cache, _case_tables, _log_fingerprints, _query_catalogs, _filter_trees, _pie_breakdowns,
+                      _case_samples, _event_stores, _session_caches, _subset_ids):
+            cache.clear()
+
+def get_query_catalog(log_view):
+    """
+    Return the query catalog of a log_view, updated with any result sets
+    registered since the last call.
+    """
+    with _cache_lock:
+        catalog = _get_attached(_query_catalogs, log_view)
+        if catalog is None:
+            catalog = _attach(_query_catalogs, log_view, QueryCatalog(log_view.query_registry))
+        return catalog.refresh()
+
+# Maps each supported metric to its column in the case metric table
+METRIC_COLUMNS = {
+    "avg_case_duration_seconds": "case_duration",
+    "avg_events_per_case": "num_events",
+    "avg_time_between_events": "avg_time_between_events"
+}
+
+# Distribution metrics: the column of the case metric table and the quantile,
+# answered from mergeable per-node histograms (see _group_sketches)
+QUANTILE_METRICS = {
+    "median_case_duration_seconds": ("case_duration", 0.5),
+    "p90_case_duration_seconds": ("case_duration", 0.9),
+    "p99_case_duration_seconds": ("case_duration", 0.99),
+    "median_time_between_events": ("avg_time_between_events", 0.5),
+    "p90_time_between_events": ("avg_time_between_events", 0.9),
+    "p99_time_between_events": ("avg_time_between_events", 0.99)
+}
+SKETCH_COLUMNS = ["case_duration", "avg_time_between_events"]
+
+# Every metric the charts can show
+ALL_METRICS = [*METRIC_COLUMNS, *QUANTILE_METRICS]
+
+# Case metric tables keyed by id() of the source log they were computed from
+_case_metrics_cache = {}
+
+# DataFrame engine for the event level work, i.e. building case metric tables
+BACKENDS = ("pandas", "polars")
+_backend = "pandas"
+
+def set_backend(backend):
+    """
+    Select the engine that builds case metric tables: "pandas" (default) or
+    "polars", which aggregates on all cores and needs the optional polars
+    package. Both produce identical tables.
+    """
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError(f"Unsupported backend: {backend}")
+    if backend == "polars":
+        try:
+            import polars
+        except ImportError as error:
+            raise ImportError("The polars backend requires the polars package.") from error
+    _backend = backend
+
+def compute_case_metrics(log_df):
+    """
+    Build a case-level table (indexed by case id) holding the duration,
+    event count and mean time between consecutive events of every case.
+    """
+    if _backend == "polars" and pd.api.types.is_datetime64_any_dtype(log_df["time:timestamp"]):
+        return _compute_case_metrics_polars(log_df)
+
+    grouped = log_df.groupby("case:concept:name", sort=True, observed=True)["time:timestamp"]
+    first = grouped.min()
+    last = grouped.max()
+    durations = (last - first).dt.total_seconds()
+
+    # The mean gap between sorted timestamps telescopes to (last - first) / (n - 1)
+    num_gaps = grouped.count() - 1
+    avg_gaps = (durations / num_gaps.where(num_gaps > 0)).fillna(0.0)
+
+    return pd.DataFrame({
+        "case_duration": durations,
+        "num_events": grouped.size(),
+        "avg_time_between_events": avg_gaps
+    })
+
+def _compute_case_metrics_polars(log_df):
+    """
+    compute_case_metrics with the per-case aggregation run as a Polars lazy
+    query. Cases are numbered in sorted order by pandas first and the
+    arithmetic on the aggregates is done like pandas does it, so the table
+    is identical to the pandas one.
+    """
+    import polars as pl
+
+    case_codes, case_ids = pd.factorize(log_df["case:concept:name"], sort=True)
+    timestamps = log_df["time:timestamp"].array
+    events = pl.DataFrame({"case": case_codes, "ticks": timestamps.asi8, "valid": ~timestamps.isna()})
+
+    valid_ticks = pl.col("ticks").filter(pl.col("valid"))
+    aggregated = (
+        events.lazy()
+        .filter(pl.col("case") >= 0)
+        .group_by("case")
+        .agg(
+            span=valid_ticks.max() - valid_ticks.min(),
+            count=pl.col("valid").sum(),
+            size=pl.len()
+        )
+        .sort("case")
+        .collect()
+    )
+
+    # Same arithmetic as the pandas path: tick differences over ticks per second
+    ticks_per_second = 10 ** 9 // pd.Timedelta(1, unit=log_df["time:timestamp"].dt.unit).value
+    durations = pd.Series(
+        aggregated["span"].to_numpy().astype(float) / ticks_per_second,
+        index=case_ids.rename("case:concept:name")
+    )
+
+    num_gaps = pd.Series(aggregated["count"].to_numpy().astype(np.int64) - 1, index=durations.index)
+    avg_gaps = (durations / num_gaps.where(num_gaps > 0)).fillna(0.0)
+
+    return pd.DataFrame({
+        "case_duration": durations,
+        "num_events": aggregated["size"].to_numpy().astype(np.int64),
+        "avg_time_between_events": avg_gaps
+    }, index=durations.index)
+
+def _cached_case_metrics(log_df):
+    entry = _get_attached(_case_metrics_cache, log_df)
+    if entry is not None and entry[0] == len(log_df):
+        _record_cache("case_metrics", True)
+        return entry[1]
+
+    if _disk_cache is not None:
+        case_metrics = _disk_cache.load_case_metrics(log_fingerprint(log_df))
+        _record_cache("disk_case_metrics", case_metrics is not None)
+        if case_metrics is not None:
+            _attach(_case_metrics_cache, log_df, (len(log_df), case_metrics))
+            return case_metrics
+
+    _record_cache("case_metrics", False)
+    return None
+
+def _remember_case_metrics(log_df, case_metrics):
+    if _disk_cache is not None:
+        _disk_cache.store_case_metrics(log_fingerprint(log_df), case_metrics)
+    _attach(_case_metrics_cache, log_df, (len(log_df), case_metrics))
+
+def get_case_metrics(log_df):
+    """
+    Return the case metric table for a source log, computing it only once
+    per log object. A log edited in place since is recomputed (see
+    _frame_snapshot).
+    """
+    case_metrics = _cached_case_metrics(log_df)
+    if case_metrics is None:
+        case_metrics = compute_case_metrics(log_df)
+        _remember_case_metrics(log_df, case_metrics)
+    return case_metrics
+
+def lookup_case_metrics(case_metrics, case_ids):
+    """
+    Return the rows of the case metric table for the given case ids.
+    """
+    positions = case_metrics.index.get_indexer(pd.unique(np.asarray(case_ids)))
+    return case_metrics.iloc[positions[positions >= 0]]
+
+def _add_case_metric(df, column):
+    case_metrics = get_case_metrics(df)
+    # A column left by an earlier call is replaced, not joined next to
+    return df.drop(columns=column, errors="ignore").join(case_metrics[column], on="case:concept:name")
 
 def add_case_durations(df):
-    grouped = df.groupby("case:concept:name")["time:timestamp"]
-    durations = (grouped.max() - grouped.min()).dt.total_seconds()
-    df = df.copy()
-    df["case_duration"] = df["case:concept:name"].map(durations)
-    return df
+    return _add_case_metric(df, "case_duration")
 
 def add_event_counts(df):
-    event_counts = df.groupby("case:concept:name").size()
-    df = df.copy()
-    df["num_events"] = df["case:concept:name"].map(event_counts)
-    return df
+    return _add_case_metric(df, "num_events")
 
 def add_avg_time_between_events(df):
-    def avg_diff(x):
-        diffs = x.sort_values().diff().dropna()
-        return diffs.mean().total_seconds() if len(diffs) > 0 else 0
-    avg_diffs = df.groupby("case:concept:name")["time:timestamp"].apply(avg_diff)
-    df = df.copy()
-    df["avg_time_between_events"] = df["case:concept:name"].map(avg_diffs)
-    return df
+    return _add_case_metric(df, "avg_time_between_events")
 
 def precompute_case_durations(log_df):
     """
     Adds a 'case_duration' column to the original log dataframe.
     """
-    case_durations = (
-        log_df.groupby("case:concept:name")["time:timestamp"]
-        .agg(["min", "max"])
-        .apply(lambda row: (row["max"] - row["min"]).total_seconds(), axis=1)
-    )
-    log_df = log_df.copy()
-    log_df["case_duration"] = log_df["case:concept:name"].map(case_durations)
-    return log_df
+    return _add_case_metric(log_df, "case_duration")
 
-def format_seconds(seconds):
-    if pd.isna(seconds):
-        return "N/A"
-    seconds = int(seconds)
-    days, rem = divmod(seconds, 86400)
-    hours, rem = divmod(rem, 3600)
-    minutes = rem // 60
-    parts = []
-    if days: parts.append(f"{days}d")
-    if hours: parts.append(f"{hours}h")
-    if minutes: parts.append(f"{minutes}m")
-    return " ".join(parts) if parts else "0m"
+_log_fingerprints = {}
 
-def compute_hover_data(df, metric):
-    import numpy as np
+def log_fingerprint(log_df):
+    """
+    Content hash of an event log (columns, dtypes and every value), computed
+    once per log object. Any change to the log yields a new fingerprint:
+    a changed copy hashes differently, and a log edited in place is hashed
+    again (see _frame_snapshot; without pandas copy-on-write, the default
+    from pandas 3.0, that check rehashes the log on every lookup).
+    """
+    entry = _get_attached(_log_fingerprints, log_df)
+    if entry is not None and entry[0] == len(log_df):
+        return entry[1]
 
-    path_cols = [col for col in df.columns if col.startswith("Level")]
-    
-    # Compute ID and parent ID using cleaned labels
-    def clean(label):
-        return label.replace("🟡 ", "").strip()
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr([(str(col), str(dtype)) for col, dtype in log_df.dtypes.items()]).encode())
+    digest.update(pd.util.hash_pandas_object(log_df, index=False).to_numpy().tobytes())
+    fingerprint = digest.hexdigest()
 
-    cleaned_path = df[path_cols].map(clean)
-    df["id"] = cleaned_path.agg(" → ".join, axis=1)
-    df["parent_id"] = cleaned_path.shift(axis=1).fillna("").agg(" → ".join, axis=1)
-    
-    df.loc[df["parent_id"].str.strip() == "", "parent_id"] = None
+    _attach(_log_fingerprints, log_df, (len(log_df), fingerprint))
+    return fingerprint
 
-    # Create lookup table for parent metrics
-    parent_lookup = df.set_index("id")[[metric, "num_cases"]].to_dict("index")
+def normalize_query_expression(query_obj):
+    return " ".join(_query_expression(query_obj).split())
 
-    hover_cases = []
-    hover_pct = []
-    hover_metric = []
-    hover_delta = []
+def _query_expression(query_obj):
+    # Queries of exported case sets have no predicates to show, their expression names the cases instead
+    case_set = _get_attached(_case_set_queries, query_obj)
+    return query_obj.as_string() if case_set is None else case_set[1]
 
-    for _, row in df.iterrows():
-        cur_val = row[metric]
-        cur_cases = row["num_cases"]
-        parent_info = parent_lookup.get(row["parent_id"])
+class DiskCache:
+    """
+    Directory of .npz files holding passing case positions per (log, query)
+    and case metric tables per log. Entries are keyed by the log fingerprint,
+    so they stop matching as soon as the log changes, and the least recently
+    used entries are deleted once the directory exceeds max_bytes. Compiled
+    logs written there by load_event_log count towards max_bytes as well.
+    """
 
-        # Cases
-        hover_cases.append(f"{cur_cases:,}")
+    def __init__(self, directory, max_bytes=1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, kind, *key_parts):
+        key = hashlib.blake2b("\0".join(key_parts).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.directory, f"{kind}-{key}.npz")
+
+    def _load(self, path):
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            return None
+        # Mark as recently used
+        os.utime(path)
+        return arrays
+
+    def _store(self, path, **arrays):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith(".npz"):
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                elif name.startswith("log-") and os.path.isdir(path):
+                    # Compiled logs are used as a whole, their meta.json is touched on every load
+                    size = sum(os.path.getsize(os.path.join(path, file_name)) for file_name in os.listdir(path))
+                    entries.append((os.stat(os.path.join(path, "meta.json")).st_mtime, size, path))
+            except OSError:
+                # Removed or still being written by another session
+                continue
 
-        # Percentage of parent
-        if parent_info and parent_info["num_cases"] > 0:
-            pct = (cur_cases / parent_info["num_cases"]) * 100
-            hover_pct.append(f"{pct:.1f}%")
-        else:
-            hover_pct.append("100%")
-
-        # Metric
-        if "duration" in metric or "time" in metric:
-            # Format time in human readable form
-            sec = cur_val
-            d = int(sec // 86400)
-            h = int((sec % 86400) // 3600)
-            m = int((sec % 3600) // 60)
-            hover_metric.append(f"{d}d {h}h {m}m")
-        else:
-            hover_metric.append(f"{cur_val:.2f}")
-
-        # Delta
-        if parent_info:
-            diff = cur_val - parent_info[metric]
-            if "duration" in metric or "time" in metric:
-                sign = "-" if diff < 0 else "+"
-                diff = abs(diff)
-                d = int(diff // 86400)
-                h = int((diff % 86400) // 3600)
-                m = int((diff % 3600) // 60)
-                hover_delta.append(f"{sign}{d}d {h}h {m}m")
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
             else:
-                sign = "-" if diff < 0 else "+"
-                hover_delta.append(f"{sign}{abs(diff):.2f}")
-        else:
-            hover_delta.append("—")
+                os.remove(path)
+            total -= size
+
+    def load_case_codes(self, fingerprint, expression):
+        arrays = self._load(self._path("query", fingerprint, expression))
+        return None if arrays is None else arrays["case_codes"]
+
+    def store_case_codes(self, fingerprint, expression, case_codes):
+        self._store(self._path("query", fingerprint, expression), case_codes=case_codes)
+
+    def load_case_metrics(self, fingerprint):
+        arrays = self._load(self._path("metrics", fingerprint))
+        if arrays is None:
+            return None
+        index = pd.Index(arrays.pop("case_id"), name="case:concept:name")
+        return pd.DataFrame(arrays, index=index)
+
+    def store_case_metrics(self, fingerprint, case_metrics):
+        case_ids = case_metrics.index.to_numpy()
+        if case_ids.dtype.kind not in "iub":
+            case_ids = case_ids.astype(str)
+        columns = {col: case_metrics[col].to_numpy() for col in case_metrics.columns}
+        self._store(self._path("metrics", fingerprint), case_id=case_ids, **columns)
+
+_disk_cache = None
+
+def set_disk_cache(directory, max_bytes=1024 ** 3):
+    """
+    Persist query results and case metric tables under the given directory
+    so later sessions on the same log start warm. Pass None to disable.
+    """
+    global _disk_cache
+    _disk_cache = DiskCache(directory, max_bytes) if directory is not None else None
+    return _disk_cache
+
+class SessionCache:
+    """
+    In-memory cache of query results (case positions) for one log_view,
+    shared by every chart call on it. Keys are the normalized query
+    expression and the identity of the subset it was evaluated on. Least
+    recently used entries are evicted beyond max_bytes.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with _cache_lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            _record_cache("session", value is not None)
+            return value
+
+    def put(self, key, value):
+        with _cache_lock:
+            if key in self._entries:
+                self.num_bytes -= self._entries.pop(key).nbytes
+            if value.nbytes > self.max_bytes:
+                return
+            self._entries[key] = value
+            self.num_bytes += value.nbytes
+            self.evict()
+
+    def evict(self):
+        with _cache_lock:
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.num_bytes -= evicted.nbytes
+
+    def clear(self):
+        with _cache_lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def items(self):
+        """
+        Snapshot of the (key, value) pairs, least recently used first. Does
+        not count as a lookup.
+        """
+        with _cache_lock:
+            return list(self._entries.items())
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.num_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None
+        }
+
+_session_caches = {}
+
+def get_session_cache(log_view, max_bytes=None):
+    """
+    Session cache of a log_view, created on first use. Passing max_bytes
+    changes its budget.
+    """
+    cache = _get_attached(_session_caches, log_view)
+    if cache is None:
+        cache = _attach(_session_caches, log_view, SessionCache())
+    if max_bytes is not None:
+        cache.max_bytes = max_bytes
+        cache.evict()
+    return cache
+
+# Subset identities for session cache keys: a number per live object, never reused
+_subset_ids = {}
+_next_subset_id = itertools.count()
+
+def subset_identity(log_df, case_codes=None):
+    """
+    Identity of a log, or of the given cases of it, as used in session cache
+    keys.
+    """
+    subset_id = _get_attached(_subset_ids, log_df)
+    if subset_id is None or subset_id[0] != len(log_df):
+        subset_id = _attach(_subset_ids, log_df, (len(log_df), next(_next_subset_id)))
+    if case_codes is None:
+        return subset_id[1]
+    return subset_id[1], hashlib.blake2b(np.ascontiguousarray(case_codes, dtype=np.int64).tobytes(), digest_size=16).hexdigest()
+
+def is_duration_metric(metric):
+    return "duration" in metric or "time" in metric
+
+def _duration_components(seconds):
+    whole = np.trunc(np.nan_to_num(seconds)).astype(np.int64)
+    days, rem = np.divmod(whole, 86400)
+    hours, rem = np.divmod(rem, 3600)
+    return days, hours, rem // 60
+
+def format_durations(seconds, compact=True):
+    """
+    Format an array of seconds as durations. compact=True omits zero
+    components ("2d 5m", "0m" when everything is zero), compact=False always
+    shows all three ("2d 0h 5m"). Missing values become "N/A".
+    """
+    seconds = np.asarray(seconds, dtype=float)
+    days, hours, minutes = (pd.Series(part) for part in _duration_components(seconds))
+
+    if compact:
+        text = (
+            (days.astype(str) + "d").where(days != 0, "") + " "
+            + (hours.astype(str) + "h").where(hours != 0, "") + " "
+            + (minutes.astype(str) + "m").where(minutes != 0, "")
+        ).str.replace(r"\s+", " ", regex=True).str.strip()
+        text = text.where(text != "", "0m")
+    else:
+        text = days.astype(str) + "d " + hours.astype(str) + "h " + minutes.astype(str) + "m"
+
+    return text.where(~np.isnan(seconds), "N/A").to_numpy(dtype=object)
+
+def format_seconds(seconds):
+    return format_durations([seconds])[0]
+
+def format_metric_values(values, metric, compact=False):
+    """
+    Format metric values as durations for time based metrics and with two
+    decimals otherwise.
+    """
+    values = np.asarray(values, dtype=float)
+    if is_duration_metric(metric):
+        return format_durations(values, compact=compact)
+    return np.char.mod("%.2f", values).astype(object)
+
+def format_deltas(differences, metric):
+    differences = np.asarray(differences, dtype=float)
+    signs = np.where(differences < 0, "-", "+").astype(object)
+    return signs + format_metric_values(np.abs(differences), metric)
+
+def format_counts(counts):
+    # Estimated counts of sampled previews are rounded for display only
+    counts = np.rint(np.asarray(counts, dtype=float)).astype(np.int64)
+    return np.array([f"{count:,}" for count in counts.tolist()], dtype=object)
+
+def format_margins(margins, metric=None):
+    """
+    Format confidence interval half widths as " ± <value>", as counts when
+    no metric is given. Missing half widths format as "".
+    """
+    margins = np.asarray(margins, dtype=float)
+    if metric is None:
+        text = " ± " + format_counts(np.rint(np.nan_to_num(margins)))
+    else:
+        text = " ± " + format_metric_values(margins, metric, compact=True)
+    return np.where(np.isnan(margins), "", text).astype(object)
+
+def format_percentages(parts, totals, decimals=1):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        shares = np.asarray(parts, dtype=float) / np.asarray(totals, dtype=float) * 100
+    return np.char.mod(f"%.{decimals}f%%", shares).astype(object)
+
+def join_path_columns(path_frame, sep=" → "):
+    """
+    Join the non-missing labels of every row of a Level1..LevelN frame into
+    one path string, one column at a time.
+    """
+    joined = pd.Series("", index=path_frame.index, dtype=object)
+    for col in path_frame.columns:
+        labels = path_frame[col]
+        prefix = joined.where(joined == "", joined + sep)
+        joined = joined.mask(labels.notna(), prefix + labels.astype(str))
+    return joined
+
+def clean_path_labels(path_frame):
+    return path_frame.apply(lambda labels: labels.str.replace("🟡 ", "").str.strip())
+
+def compute_hover_data(df, metric):
+    path_cols = [col for col in df.columns if col.startswith("Level")]
 
-    df["hover_cases"] = hover_cases
-    df["hover_pct"] = hover_pct
-    df["hover_metric"] = hover_metric
-    df["hover_delta"] = hover_delta
+    # Compute ID and parent ID using cleaned labels
+    df["id"] = join_path_columns(clean_path_labels(df[path_cols]))
+    df["parent_id"] = df["id"].str.rpartition(" → ")[0]
+    df.loc[df["parent_id"].str.strip() == "", "parent_id"] = None
+
+    # Look up the metrics of every row's parent
+    parents = df.drop_duplicates("id", keep="last").set_index("id")
+    parent_cases = df["parent_id"].map(parents["num_cases"])
+    parent_values = df["parent_id"].map(parents[metric])
+    has_parent = parent_cases.notna().to_numpy()
+
+    df["hover_cases"] = format_counts(df["num_cases"])
+    df["hover_pct"] = np.where(
+        has_parent & (parent_cases.fillna(0).to_numpy() > 0),
+        format_percentages(df["num_cases"], parent_cases),
+        "100%"
+    )
+    df["hover_metric"] = format_metric_values(df[metric], metric)
+    df["hover_delta"] = np.where(
+        has_parent,
+        format_deltas(df[metric] - parent_values, metric),
+        "—"
+    )
     return df
 
-def compute_case_stats(df, name, label_path, metric):
+def compute_case_stats(df, name, label_path, metric, case_metrics=None):
     if df.empty:
         return {
             "subset_name": name,
@@ -159,21 +736,1083 @@ def compute_case_stats(df, name, label_path, metric):
             metric: 0
         }
 
-    df = df.drop_duplicates("case:concept:name")
-
-    column = {
-        "avg_case_duration_seconds": "case_duration",
-        "avg_events_per_case": "num_events",
-        "avg_time_between_events": "avg_time_between_events"
-    }[metric]
+    if case_metrics is None:
+        case_metrics = get_case_metrics(df)
+    cases = lookup_case_metrics(case_metrics, df["case:concept:name"])
 
     return {
         "subset_name": name,
         "label_path": " → ".join(label_path),
-        "num_cases": df["case:concept:name"].nunique(),
-        metric: df[column].mean()
+        "num_cases": len(cases),
+        metric: cases[METRIC_COLUMNS[metric]].mean()
     }
 
+def _group_moments(groups, values, num_groups):
+    """
+    Number of non-NaN values and their sum per group, for groups labelled
+    0..num_groups-1. Moments of disjoint case sets merge by addition.
+    """
+    valid = ~np.isnan(values)
+    num_valid = np.bincount(groups, weights=valid, minlength=num_groups)
+    sums = np.bincount(groups, weights=np.where(valid, values, 0.0), minlength=num_groups)
+    return num_valid, sums
+
+def _group_means(groups, values, num_groups):
+    """
+    Size and mean of values per group, for groups labelled 0..num_groups-1.
+    NaN values are skipped in the mean, like pandas does.
+    """
+    counts = np.bincount(groups, minlength=num_groups)
+    num_valid, sums = _group_moments(groups, values, num_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return counts, sums / num_valid
+
+# Relative accuracy of the quantile sketches, which are histograms over
+# logarithmically spaced bins
+SKETCH_ACCURACY = 0.01
+_SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+
+def sketch_bins(values, first=None):
+    """
+    Sketch bin of every value and the raw index of bin 1. Bin 0 holds zero
+    and negative values, missing values get -1. By default bin 1 is the bin
+    of the smallest positive value.
+    """
+    values = np.asarray(values, dtype=float)
+    positive = values > 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        raw = np.ceil(np.log(np.where(positive, values, 1.0)) / np.log(_SKETCH_GAMMA)).astype(np.int64)
+    if first is None:
+        first = int(raw[positive].min()) if positive.any() else 0
+    bins = np.where(positive, raw - first + 1, 0)
+    return np.where(np.isnan(values), -1, bins), first
+
+def _group_sketches(groups, num_groups, bins, width, weights=None):
+    """
+    Histogram of every sketch column per group, shaped (groups, columns,
+    width). Sketches of disjoint case sets merge by addition.
+    """
+    sketches = np.zeros((num_groups, bins.shape[1], width), dtype=float if weights is not None else np.int64)
+    for c in range(bins.shape[1]):
+        valid = bins[:, c] >= 0
+        cells = groups[valid] * width + bins[valid, c]
+        counts = np.bincount(cells, weights=None if weights is None else weights[valid], minlength=num_groups * width)
+        sketches[:, c] = counts.reshape(num_groups, width)
+    return sketches
+
+def _sketch_quantiles(sketches, first_bins):
+    """
+    Every quantile metric per group from sketches shaped (groups, columns,
+    width); NaN for groups without values.
+    """
+    stats = {}
+    cumulative = np.cumsum(sketches, axis=2)
+    for metric, (column, q) in QUANTILE_METRICS.items():
+        c = SKETCH_COLUMNS.index(column)
+        totals = cumulative[:, c, -1]
+        bins = np.argmax(cumulative[:, c] >= q * totals[:, None], axis=1)
+        # Bin i covers (gamma^(i-1), gamma^i], estimated by its relative midpoint
+        values = 2 * _SKETCH_GAMMA ** (bins - 1 + first_bins[c]) / (_SKETCH_GAMMA + 1)
+        stats[metric] = np.where(totals > 0, np.where(bins == 0, 0.0, values), np.nan)
+    return stats
+
+# z value of the confidence intervals of sampled previews (95%)
+CONFIDENCE_Z = 1.96
+
+def _sampled_group_stats(groups, num_groups, strata, values, sample):
+    """
+    Estimated case count and metric means per group from a stratified case
+    sample (a CaseSample), with the half widths of their confidence
+    intervals. groups, strata and the rows of values (one column per
+    metric) are aligned per sampled case.
+    Counts use the stratified expansion estimator, means the weighted ratio
+    estimator with a linearized variance.
+    """
+    population, sampled = sample.stratum_sizes, sample.stratum_samples
+    num_strata = len(population)
+    fpc = population.astype(float) ** 2 * (1 - sampled / population) / sampled
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weights = population / sampled
+
+    def stratum_variance(cell_sums, cell_squares):
+        # Variance of the per-stratum estimate of a total, per group
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance = (cell_squares - cell_sums ** 2 / sampled) / (sampled - 1)
+        variance = np.where(sampled > 1, variance, 0.0)
+        return np.clip(variance, 0.0, None) @ fpc
+
+    cells = groups * num_strata + strata
+    num_cells = num_groups * num_strata
+    counts = np.bincount(cells, minlength=num_cells).reshape(num_groups, num_strata)
+    estimated_cases = counts @ weights
+    count_margins = CONFIDENCE_Z * np.sqrt(stratum_variance(counts, counts))
+
+    # Estimates stay unrounded, so the counts of disjoint groups add up to the count of their union
+    stats = {"num_cases": estimated_cases, "num_cases_ci": count_margins}
+    for j, metric in enumerate(METRIC_COLUMNS):
+        column = values[:, j]
+        valid = ~np.isnan(column)
+        case_weights = np.where(valid, weights[strata], 0.0)
+        total_weight = np.bincount(groups, weights=case_weights, minlength=num_groups)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.bincount(groups, weights=case_weights * np.nan_to_num(column), minlength=num_groups) / total_weight
+
+        # Residuals of the ratio estimator, zero outside the group
+        residuals = np.where(valid, column - means[groups], 0.0)
+        cell_sums = np.bincount(cells, weights=residuals, minlength=num_cells).reshape(num_groups, num_strata)
+        cell_squares = np.bincount(cells, weights=residuals ** 2, minlength=num_cells).reshape(num_groups, num_strata)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            margins = CONFIDENCE_Z * np.sqrt(stratum_variance(cell_sums, cell_squares)) / total_weight
+
+        stats[metric] = means
+        stats[f"{metric}_ci"] = margins
+    return stats
+
+def evaluate_case_codes(log_view, log_df, query_obj, case_metrics):
+    """
+    Evaluate a query once on a log and return the sorted positions, in the
+    case metric table, of the cases that pass it.
+    """
+    case_codes = _cached_case_codes(log_view, log_df, query_obj)
+    if case_codes is not None:
+        return case_codes
+
+    case_codes = _native_case_codes(log_df, query_obj, case_metrics)
+    if case_codes is None:
+        df_filtered, _ = evaluate_query(log_view, log_df, query_obj)
+        positions = case_metrics.index.get_indexer(pd.unique(df_filtered["case:concept:name"]))
+        case_codes = np.sort(positions[positions >= 0])
+    _remember_case_codes(log_view, log_df, query_obj, case_codes)
+    return case_codes
+
+def _cached_case_codes(log_view, log_df, query_obj):
+    # Session cache first, then the disk cache, which warms the session cache
+    expression = normalize_query_expression(query_obj)
+    session_key = (expression, subset_identity(log_df))
+    case_codes = get_session_cache(log_view).get(session_key)
+    if case_codes is not None or _disk_cache is None:
+        return case_codes
+
+    case_codes = _disk_cache.load_case_codes(log_fingerprint(log_df), expression)
+    _record_cache("disk_query_results", case_codes is not None)
+    if case_codes is not None:
+        get_session_cache(log_view).put(session_key, case_codes)
+    return case_codes
+
+def _remember_case_codes(log_view, log_df, query_obj, case_codes):
+    expression = normalize_query_expression(query_obj)
+    get_session_cache(log_view).put((expression, subset_identity(log_df)), case_codes)
+    if _disk_cache is not None:
+        _disk_cache.store_case_codes(log_fingerprint(log_df), expression, case_codes)
+
+def resolve_n_jobs(n_jobs):
+    """
+    Number of worker processes for n_jobs, where negative values count back
+    from the number of cores (-1 uses all of them).
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max((os.cpu_count() or 1) + 1 + n_jobs, 1)
+    return max(n_jobs, 1)
+
+CASE_METRIC_DTYPES = {
+    "case_duration": np.float64,
+    "num_events": np.int64,
+    "avg_time_between_events": np.float64
+}
+
+# Log, shard assignment, case index, evaluator and queries of a worker process
+_shard_state = None
+
+def _init_shard_worker(state):
+    global _shard_state
+    _shard_state = state
+
+def _create_shared_array(shape, dtype):
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    array.fill(0)
+    return shm, array
+
+def _write_shared_array(spec, index, values):
+    shape, dtype, name = spec
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf)[index] = values
+    finally:
+        shm.close()
+
+def _evaluate_shard(shard, layout):
+    """
+    Evaluate every query, and the case metrics if requested, on the events of
+    one shard and write the results into the shared arrays of the layout.
+    """
+    log_df, shard_of_event, case_index, query_evaluator, queries = _shard_state
+    shard_df = log_df[shard_of_event == shard]
+
+    for j, query_obj in enumerate(queries):
+        df_filtered, _ = query_evaluator.evaluate(shard_df, query_obj)
+        positions = case_index.get_indexer(pd.unique(df_filtered["case:concept:name"]))
+        _write_shared_array(layout["membership"], (j, positions[positions >= 0]), True)
+
+    if "metrics" in layout:
+        shard_metrics = compute_case_metrics(shard_df)
+        positions = case_index.get_indexer(shard_metrics.index)
+        for column, spec in layout["metrics"].items():
+            _write_shared_array(spec, positions, shard_metrics[column].to_numpy())
+
+def _evaluate_sharded(log_view, log_df, queries, n_jobs, case_metrics=None):
+    """
+    Evaluate queries, and the case metric table when case_metrics is None, on
+    case-hash shards of a log in a pool of n_jobs processes. Every case lives
+    in exactly one shard, so the shard results are merged by writing them at
+    the case positions of shared arrays.
+    """
+    case_ids = log_df["case:concept:name"]
+    if case_metrics is None:
+        event_cases, case_index = pd.factorize(case_ids, sort=True)
+        case_index = pd.Index(case_index, name="case:concept:name")
+    else:
+        case_index = case_metrics.index
+        event_cases = case_index.get_indexer(case_ids)
+
+    shard_of_case = pd.util.hash_array(case_index.to_numpy()) % np.uint64(n_jobs)
+    shard_of_event = np.where(event_cases >= 0, shard_of_case[event_cases].astype(np.int64), -1)
+
+    blocks = []
+    arrays = {}
+
+    def shared(key, shape, dtype):
+        shm, array = _create_shared_array(shape, dtype)
+        blocks.append(shm)
+        arrays[key] = array
+        return (shape, dtype, shm.name)
+
+    try:
+        layout = {"membership": shared("membership", (len(queries), len(case_index)), bool)}
+        if case_metrics is None:
+            layout["metrics"] = {
+                column: shared(column, (len(case_index),), dtype)
+                for column, dtype in CASE_METRIC_DTYPES.items()
+            }
+
+        # Forked workers read the log through copy-on-write memory instead of pickling it.
+        # Forking from any thread but the main one (e.g. a ChartJob) can deadlock the
+        # workers, so there they start from a fresh process and get the state pickled.
+        start_methods = multiprocessing.get_all_start_methods()
+        if threading.current_thread() is threading.main_thread() and "fork" in start_methods:
+            context = multiprocessing.get_context("fork")
+        else:
+            context = multiprocessing.get_context("forkserver" if "forkserver" in start_methods else "spawn")
+        state = (log_df, shard_of_event, case_index, log_view.query_evaluator, queries)
+        _record_evaluation(len(log_df) * len(queries), len(queries) * n_jobs)
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context,
+                                 initializer=_init_shard_worker, initargs=(state,)) as pool:
+            list(pool.map(_evaluate_shard, range(n_jobs), [layout] * n_jobs))
+
+        case_codes = [np.flatnonzero(row) for row in arrays["membership"]]
+        if case_metrics is None:
+            case_metrics = pd.DataFrame(
+                {column: arrays[column].copy() for column in CASE_METRIC_DTYPES},
+                index=case_index
+            )
+    finally:
+        arrays.clear()
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return case_metrics, case_codes
+
+def evaluate_case_codes_batch(log_view, log_df, queries, n_jobs=1):
+    """
+    evaluate_case_codes for several queries on one log, in query order.
+    With n_jobs > 1 the queries missing from the caches are evaluated on
+    case-hash shards of the log in a process pool, together with the case
+    metric table if it is not known yet. Results equal the serial path.
+    """
+    n_jobs = resolve_n_jobs(n_jobs)
+    if n_jobs == 1:
+        case_metrics = get_case_metrics(log_df)
+        return [evaluate_case_codes(log_view, log_df, query_obj, case_metrics) for query_obj in queries]
+
+    case_metrics = _cached_case_metrics(log_df)
+    results = [_cached_case_codes(log_view, log_df, query_obj) for query_obj in queries]
+    missing = [j for j, case_codes in enumerate(results) if case_codes is None]
+
+    # Exported case sets are looked up, not evaluated, and never go to the pool
+    for j in missing:
+        if _case_set_members(queries[j]) is not None:
+            results[j] = evaluate_case_codes(log_view, log_df, queries[j], get_case_metrics(log_df))
+    missing = [j for j in missing if results[j] is None]
+
+    # Queries the native evaluator handles never go to the pool
+    if _native_evaluation and missing:
+        case_metrics = get_case_metrics(log_df)
+        for j in missing:
+            results[j] = _native_case_codes(log_df, queries[j], case_metrics)
+            if results[j] is not None:
+                _remember_case_codes(log_view, log_df, queries[j], results[j])
+        missing = [j for j in missing if results[j] is None]
+
+    if not missing and case_metrics is not None:
+        return results
+
+    computed_metrics, computed_codes = _evaluate_sharded(
+        log_view, log_df, [queries[j] for j in missing], n_jobs, case_metrics
+    )
+    if case_metrics is None:
+        _remember_case_metrics(log_df, computed_metrics)
+    for j, case_codes in zip(missing, computed_codes):
+        _remember_case_codes(log_view, log_df, queries[j], case_codes)
+        results[j] = case_codes
+    return results
+
+class CaseTable:
+    """
+    Shared base of all subsets of one source log: the event log and its case
+    metric table. Subsets refer to cases by their position in the metric
+    table and only become event-level frames through events().
+
+    The log is only referenced weakly, so the table, which is cached per log,
+    does not keep it alive. Holders of a table that need its events, like
+    FilterTree and CaseSet, keep their own reference to the log.
+    """
+
+    def __init__(self, log_df, case_metrics):
+        self._log_ref = weakref.ref(log_df)
+        self.case_metrics = case_metrics
+        self._event_cases = None
+        self._metric_values = None
+        self._sketch_bins = None
+
+    def __len__(self):
+        return len(self.case_metrics)
+
+    @property
+    def log_df(self):
+        log_df = self._log_ref()
+        if log_df is None:
+            raise ValueError("The log of this case table no longer exists.")
+        return log_df
+
+    def event_cases(self):
+        """
+        Position of the case of every event row, computed on first use.
+        """
+        if self._event_cases is None:
+            self._event_cases = self.case_metrics.index.get_indexer(self.log_df["case:concept:name"])
+        return self._event_cases
+
+    def metric_values(self):
+        """
+        Float matrix of all supported metrics, one column per entry of
+        METRIC_COLUMNS, computed on first use.
+        """
+        if self._metric_values is None:
+            self._metric_values = self.case_metrics[list(METRIC_COLUMNS.values())].to_numpy(dtype=float)
+        return self._metric_values
+
+    def sketch_bins(self):
+        """
+        Sketch bin of every case per SKETCH_COLUMNS column, the raw index of
+        bin 1 per column and the common sketch width, computed on first use.
+        """
+        if self._sketch_bins is None:
+            columns = [sketch_bins(self.case_metrics[column]) for column in SKETCH_COLUMNS]
+            bins = np.column_stack([column_bins for column_bins, _ in columns])
+            width = int(bins.max()) + 1 if bins.size else 1
+            self._sketch_bins = (bins, [first for _, first in columns], width)
+        return self._sketch_bins
+
+    def case_codes(self, case_ids):
+        positions = self.case_metrics.index.get_indexer(pd.unique(np.asarray(case_ids)))
+        return np.sort(positions[positions >= 0])
+
+    def case_ids(self, case_codes):
+        return self.case_metrics.index[case_codes]
+
+    def events(self, case_codes):
+        """
+        Materialize the event rows of the given cases, in log order.
+        """
+        selected = np.zeros(len(self.case_metrics) + 1, dtype=bool)
+        selected[case_codes] = True
+        # Events whose case is unknown map to -1, i.e. the extra last slot
+        return self.log_df[selected[self.event_cases()]]
+
+    def appended(self, log_df, new_events):
+        """
+        Case table of log_df, which is this table's log with new_events
+        appended. Only the cases of new_events are recomputed, from their
+        earlier events and the new ones. New cases are added after the known
+        ones, so every known case keeps its position. Returns the table and
+        the sorted positions of the affected cases.
+        """
+        case_ids = pd.unique(np.asarray(new_events["case:concept:name"]))
+        positions = self.case_metrics.index.get_indexer(case_ids)
+        is_new = positions < 0
+        positions[is_new] = len(self) + np.arange(is_new.sum())
+
+        known = np.sort(positions[~is_new])
+        affected_metrics = compute_case_metrics(pd.concat([self.events(known), new_events]))
+        updated_ids = self.case_metrics.index[known]
+        added_ids = case_ids[is_new]
+
+        columns = {}
+        for column in self.case_metrics.columns:
+            values = self.case_metrics[column].to_numpy().copy()
+            values[known] = affected_metrics.loc[updated_ids, column].to_numpy()
+            columns[column] = np.concatenate([values, affected_metrics.loc[added_ids, column].to_numpy()])
+        index = self.case_metrics.index.append(pd.Index(added_ids, name=self.case_metrics.index.name))
+        case_table = CaseTable(log_df, pd.DataFrame(columns, index=index))
+
+        # Extend the per-case and per-event arrays already computed instead of recomputing them
+        affected = np.sort(positions)
+        if self._event_cases is not None:
+            new_event_cases = positions[pd.Index(case_ids).get_indexer(new_events["case:concept:name"])]
+            case_table._event_cases = np.concatenate([self._event_cases, new_event_cases])
+        if self._metric_values is not None:
+            metric_values = np.concatenate([self._metric_values, np.empty((is_new.sum(), len(METRIC_COLUMNS)))])
+            metric_values[affected] = np.column_stack(
+                [columns[column][affected] for column in METRIC_COLUMNS.values()]
+            ).astype(float)
+            case_table._metric_values = metric_values
+        if self._sketch_bins is not None:
+            bins, first_bins, width = self._sketch_bins
+            affected_bins = np.column_stack(
+                [sketch_bins(columns[column][affected], first)[0] for column, first in zip(SKETCH_COLUMNS, first_bins)]
+            )
+            # Values below bin 1 need a new binning, left to sketch_bins() on first use
+            positive = np.column_stack([columns[column][affected] > 0 for column in SKETCH_COLUMNS])
+            if not (affected_bins[positive] < 1).any():
+                bins = np.concatenate([bins, np.empty((is_new.sum(), bins.shape[1]), dtype=bins.dtype)])
+                bins[affected] = affected_bins
+                width = max(width, int(affected_bins.max()) + 1 if affected_bins.size else 1)
+                case_table._sketch_bins = (bins, first_bins, width)
+        return case_table, affected
+
+_case_tables = {}
+
+def get_case_table(log_df):
+    case_metrics = get_case_metrics(log_df)
+    case_table = _get_attached(_case_tables, log_df)
+    if case_table is None or case_table.case_metrics is not case_metrics:
+        case_table = _attach(_case_tables, log_df, CaseTable(log_df, case_metrics))
+    return case_table
+
+class EventStore:
+    """
+    Compiled form of a log for the native evaluator: the events sorted by
+    (case, timestamp) as an order over the log rows, the offsets of every
+    case in that order (cases numbered like the case metric table) and
+    int64 timestamps. Attribute columns are compiled to categorical codes
+    or numeric arrays on first use.
+    """
+
+    def __init__(self, case_table):
+        self.case_table = case_table
+        event_cases = case_table.event_cases()
+        known = np.flatnonzero(event_cases >= 0)
+        timestamps = case_table.log_df["time:timestamp"].to_numpy(dtype="datetime64[ns]").view(np.int64)
+
+        self.order = known[np.lexsort((timestamps[known], event_cases[known]))]
+        self.case_offsets = np.zeros(len(case_table) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(event_cases[known], minlength=len(case_table)), out=self.case_offsets[1:])
+        self.timestamps = timestamps[self.order]
+        self._columns = {}
+
+    def column(self, name):
+        """
+        (values, uniques) of an attribute column in log row order: numeric
+        columns as they are with uniques None, others as factorized codes.
+        """
+        if name not in self._columns:
+            series = self.case_table.log_df[name]
+            if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+                self._columns[name] = (series.to_numpy(dtype=float), None)
+            elif isinstance(series.dtype, pd.CategoricalDtype):
+                # Already encoded, missing values are -1 like with factorize
+                self._columns[name] = (series.cat.codes.to_numpy(), series.cat.categories)
+            else:
+                self._columns[name] = pd.factorize(series)
+        return self._columns[name]
+
+    def first_events(self):
+        return self.order[self.case_offsets[:-1]]
+
+    def last_events(self):
+        return self.order[self.case_offsets[1:] - 1]
+
+_event_stores = {}
+
+def get_event_store(log_df):
+    case_table = get_case_table(log_df)
+    event_store = _get_attached(_event_stores, log_df)
+    if event_store is None or event_store.case_table is not case_table:
+        event_store = _attach(_event_stores, log_df, EventStore(case_table))
+    return event_store
+
+class CaseSet:
+    """
+    Handle on the cases of a tree node or pie slice: sorted case positions
+    in a CaseTable, without any event-level copy. Supports len(), `in` and
+    set operations with case sets of the same table; events are only
+    materialized when iterated or exported.
+    """
+
+    def __init__(self, case_table, case_codes):
+        self.case_table = case_table
+        self.case_codes = case_codes
+        # The table holds its log weakly, the handle keeps it for the events
+        self.log_df = case_table.log_df
+
+    def __len__(self):
+        return len(self.case_codes)
+
+    def count(self):
+        return len(self.case_codes)
+
+    def __contains__(self, case_id):
+        return bool(self.contains([case_id])[0])
+
+    def contains(self, case_ids):
+        """
+        Whether each of the given case ids is in the set, as a boolean array.
+        """
+        positions = self.case_table.case_metrics.index.get_indexer(np.asarray(case_ids))
+        if len(self.case_codes) == 0:
+            return np.zeros(len(positions), dtype=bool)
+        found = np.minimum(np.searchsorted(self.case_codes, positions), len(self.case_codes) - 1)
+        return (positions >= 0) & (self.case_codes[found] == positions)
+
+    def _check_table(self, other):
+        if other.case_table is not self.case_table:
+            raise ValueError("Case sets of different logs cannot be combined.")
+
+    def intersect(self, other):
+        self._check_table(other)
+        return CaseSet(self.case_table, np.intersect1d(self.case_codes, other.case_codes, assume_unique=True))
+
+    def union(self, other):
+        self._check_table(other)
+        return CaseSet(self.case_table, np.union1d(self.case_codes, other.case_codes))
+
+    def difference(self, other):
+        self._check_table(other)
+        return CaseSet(self.case_table, np.setdiff1d(self.case_codes, other.case_codes, assume_unique=True))
+
+    __and__ = intersect
+    __or__ = union
+    __sub__ = difference
+
+    def case_ids(self):
+        return self.case_table.case_ids(self.case_codes)
+
+    def metrics(self):
+        """
+        Rows of the case metric table for the cases of the set.
+        """
+        return self.case_table.case_metrics.iloc[self.case_codes]
+
+    def event_positions(self):
+        """
+        Row positions in the log of all events of the set, in (case,
+        timestamp) order, taken from the log's EventStore.
+        """
+        event_store = get_event_store(self.log_df)
+        starts = event_store.case_offsets[self.case_codes]
+        lengths = event_store.case_offsets[self.case_codes + 1] - starts
+        # Consecutive ranges of the sorted order, one per case, without a Python loop
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        return event_store.order[offsets]
+
+    def iter_events(self, page_size=10_000):
+        """
+        Yield the events of the set in (case, timestamp) order, in frames of
+        at most page_size rows. Only one page is materialized at a time.
+        """
+        positions = self.event_positions()
+        for start in range(0, len(positions), page_size):
+            yield self.log_df.iloc[positions[start:start + page_size]]
+
+    def to_result_set(self, log_view, name):
+        """
+        Register the set as result set `name` of its log through the
+        log_view's evaluate_query and return its events. The recorded query
+        is a logview Query named after the result set with one Union of
+        EqToConstant predicates on the case ids of the set, so logview
+        reproduces the membership wherever it evaluates the query. Charts
+        and caches here select the cases directly instead (see
+        _case_set_members), as a Union of many predicates is slow to
+        evaluate; the registration itself evaluates it once.
+        """
+        from logview.predicate import EqToConstant, Query, Union
+
+        log_df = self.log_df
+        source_log_name = next(
+            (source for source, frame in log_view.result_set_name_cache.items() if frame is log_df), None
+        )
+        if source_log_name is None:
+            raise ValueError("Only case sets of a log held by the log_view can be exported.")
+        if len(self) == 0:
+            raise ValueError("An empty case set cannot be exported.")
+
+        case_ids = pd.Index(self.case_ids())
+        query_obj = Query(
+            name, [Union(*(EqToConstant("case:concept:name", case_id) for case_id in case_ids.tolist()))]
+        )
+        # Named by a hash of the case ids, so session and disk cache keys tell sets apart
+        digest = hashlib.blake2b(pd.util.hash_pandas_object(case_ids, index=False).to_numpy().tobytes(), digest_size=8)
+        _attach(_case_set_queries, query_obj, (case_ids, f"CaseSet {name} ({len(case_ids)} cases, {digest.hexdigest()})"))
+
+        df_filtered, _ = log_view.evaluate_query(name, log_df, query_obj)
+        return df_filtered
+
+# Case ids and expression of the queries exported case sets are registered
+# with, keyed by id() of the query
+_case_set_queries = {}
+
+def _case_set_members(query_obj):
+    """
+    Case ids passing the query of a result set exported by
+    CaseSet.to_result_set, None for any other query. evaluate_query keeps
+    the events of these cases instead of handing their Union to the query
+    evaluator, with the same result.
+    """
+    case_set = _get_attached(_case_set_queries, query_obj)
+    return None if case_set is None else case_set[0]
+
+# Event attribute comparisons the native evaluator handles, by predicate class name.
+# A case passes when any of its events matches, except for the negated ones,
+# where it passes when none of its events matches (NotEqToConstant keeps the
+# cases without an event where attribute == value).
+NATIVE_COMPARISONS = {
+    "EqToConstant": operator.eq,
+    "NotEqToConstant": operator.eq,
+    "GreaterEqualToConstant": operator.ge,
+    "GreaterThanConstant": operator.gt,
+    "LessThanConstant": operator.lt,
+    "LessEqualToConstant": operator.le
+}
+NEGATED_COMPARISONS = {"NotEqToConstant"}
+
+_native_evaluation = False
+
+def set_native_evaluation(enabled=True):
+    """
+    Evaluate supported queries on a compiled EventStore instead of the
+    log_view's query evaluator. Queries with other predicates still go to
+    the query evaluator.
+    """
+    global _native_evaluation
+    _native_evaluation = enabled
+
+def _predicate_fields(predicate, *names):
+    # Values of the named logview fields of a predicate, None when it lacks any of them
+    values = tuple(getattr(predicate, name, None) for name in names)
+    return None if any(value is None for value in values) else values
+
+def _native_predicate_cases(event_store, predicate):
+    # Boolean mask over the cases passing one predicate, None when unsupported
+    kind = type(predicate).__name__
+    num_cases = len(event_store.case_table)
+    log_df = event_store.case_table.log_df
+
+    if kind in NATIVE_COMPARISONS:
+        fields = _predicate_fields(predicate, "attribute_key", "value")
+        if fields is None or fields[0] not in log_df.columns:
+            return None
+        key, value = fields
+        compare = NATIVE_COMPARISONS[kind]
+        values, uniques = event_store.column(key)
+        if uniques is None and not isinstance(value, (int, float, np.number)):
+            return None
+        try:
+            if uniques is None:
+                matches = compare(values, value)
+            else:
+                # Compare the distinct values once; the extra last slot stands for missing values
+                candidates = pd.Series(np.append(np.asarray(uniques, dtype=object), np.nan))
+                matches = compare(candidates, value).to_numpy(dtype=bool)[values]
+        except TypeError:
+            return None
+        passing = np.zeros(num_cases + 1, dtype=bool)
+        passing[event_store.case_table.event_cases()[matches]] = True
+        if kind in NEGATED_COMPARISONS:
+            return ~passing[:num_cases]
+        return passing[:num_cases]
+
+    if kind in ("StartWith", "EndWith"):
+        fields = _predicate_fields(predicate, "values")
+        if fields is None:
+            return None
+        activities, = fields
+        if isinstance(activities, str):
+            activities = [activities]
+        codes, uniques = event_store.column("concept:name")
+        if uniques is None:
+            return None
+        wanted = np.append(pd.Index(uniques).isin(list(activities)), False)
+        events = event_store.first_events() if kind == "StartWith" else event_store.last_events()
+        passing = np.zeros(num_cases, dtype=bool)
+        non_empty = np.diff(event_store.case_offsets) > 0
+        passing[non_empty] = wanted[codes[events[non_empty]]]
+        return passing
+
+    if kind == "DurationWithin":
+        fields = _predicate_fields(predicate, "min_duration_seconds", "max_duration_seconds")
+        if fields is None:
+            return None
+        low, high = fields
+        # Durations between the first and last valid timestamp, like logview; they are
+        # NaN for cases without any, which are never within range
+        durations = event_store.case_table.case_metrics["case_duration"].to_numpy(dtype=float)
+        with np.errstate(invalid="ignore"):
+            return (durations >= low) & (durations <= high)
+
+    return None
+
+def _native_case_codes(log_df, query_obj, case_metrics):
+    """
+    Case positions passing a query, computed on the EventStore of the log,
+    or None when native evaluation is off or the query is not supported.
+    Predicates of a query are combined with AND. Queries with more than one
+    event attribute comparison are left to the query evaluator, which
+    defines whether those must hold on the same event.
+    """
+    if not _native_evaluation:
+        return None
+    predicates = getattr(query_obj, "predicates", None)
+    if not isinstance(predicates, (list, tuple)) or not predicates:
+        return None
+    if sum(type(predicate).__name__ in NATIVE_COMPARISONS for predicate in predicates) > 1:
+        return None
+
+    event_store = get_event_store(log_df)
+    if event_store.case_table.case_metrics is not case_metrics:
+        return None
+
+    passing = np.ones(len(case_metrics), dtype=bool)
+    for predicate in predicates:
+        predicate_cases = _native_predicate_cases(event_store, predicate)
+        if predicate_cases is None:
+            return None
+        passing &= predicate_cases
+    return np.flatnonzero(passing)
+
+class CaseSample:
+    """
+    Seeded sample of whole cases of a log, stratified by the number of
+    events per case (powers of two) with proportional allocation and at
+    least two cases per stratum. log_df holds the events of the sampled
+    cases and case_strata the stratum of every sampled case.
+    """
+
+    def __init__(self, log_df, sample_size, seed=0):
+        case_codes, case_ids = pd.factorize(log_df["case:concept:name"])
+        events_per_case = np.bincount(case_codes[case_codes >= 0], minlength=len(case_ids))
+        _, strata = np.unique(np.minimum(np.log2(events_per_case).astype(int), 15), return_inverse=True)
+        population = np.bincount(strata)
+
+        num_cases = len(case_ids)
+        allocation = np.rint(min(sample_size, num_cases) * population / max(num_cases, 1))
+        allocation = np.minimum(population, np.maximum(allocation, np.minimum(population, 2))).astype(np.int64)
+
+        # Random order within each stratum, keep the first allocated cases
+        order = np.lexsort((np.random.default_rng(seed).random(num_cases), strata))
+        stratum_starts = np.cumsum(population) - population
+        rank = np.empty(num_cases, dtype=np.int64)
+        rank[order] = np.arange(num_cases) - stratum_starts[strata[order]]
+        selected = rank < allocation[strata]
+
+        # Events of unknown cases map to -1, i.e. the extra last slot
+        self.log_df = log_df[np.append(selected, False)[case_codes]]
+        self.case_strata = pd.Series(strata[selected], index=case_ids[selected])
+        self.stratum_sizes = population
+        self.stratum_samples = allocation
+        self.num_cases = num_cases
+        self.sample_size = int(selected.sum())
+        self.seed = seed
+
+    def strata_of(self, case_ids):
+        return self.case_strata.reindex(case_ids).to_numpy()
+
+    @property
+    def scale(self):
+        # Population cases per sampled case
+        return self.num_cases / max(self.sample_size, 1)
+
+_case_samples = {}
+
+def get_case_sample(log_df, sample_size, seed=0):
+    """
+    CaseSample of a log, cached per log, sample size and seed.
+    """
+    samples = _get_attached(_case_samples, log_df)
+    if samples is None:
+        samples = _attach(_case_samples, log_df, {})
+    key = (sample_size, seed, len(log_df))
+    if key not in samples:
+        samples[key] = CaseSample(log_df, sample_size, seed)
+    return samples[key]
+
+class Preview:
+    """
+    Chart computed on a CaseSample. data holds the node or slice table with
+    estimated case counts and metrics and the half widths of their
+    confidence intervals (*_ci columns), fig the figure. refine() computes
+    the exact chart with the same arguments and returns its result.
+    """
+
+    def __init__(self, sample, data, fig, refine):
+        self.sample = sample
+        self.data = data
+        self.fig = fig
+        self._refine = refine
+
+    def refine(self):
+        return self._refine()
+
+# Branch of a node below its parent: passing, complement, or folded small branches
+FILTERED_BRANCH, COMPLEMENT_BRANCH, OTHER_BRANCH = 0, 1, 2
+BRANCH_CODES = {FILTERED_BRANCH: "F", COMPLEMENT_BRANCH: "C", OTHER_BRANCH: "O"}
+
+class SubsetNode:
+    """
+    One subset of a filter tree, holding its cases as sorted positions in a
+    CaseTable. A node stores only its own label and branch; paths and names
+    are rebuilt by walking up the parents. Once aggregated, stats holds every
+    metric over its cases, sketch the histograms its quantiles come from and
+    moments the non-NaN count and sum of every metric its means come from.
+    """
+
+    __slots__ = (
+        "parent", "label", "branch", "step", "cases", "is_main_path", "root_name", "depth", "children", "stats", "sketch",
+        "moments"
+    )
+
+    def __init__(self, parent, label, branch, step, cases, is_main_path, root_name=None):
+        self.parent = parent
+        self.label = label
+        self.branch = branch
+        self.step = step
+        self.cases = cases
+        self.is_main_path = is_main_path
+        self.root_name = root_name
+        self.depth = 0 if parent is None else parent.depth + 1
+        # None until the node is expanded or aggregated
+        self.children = None
+        self.stats = None
+        self.sketch = None
+        self.moments = None
+
+    def __len__(self):
+        return len(self.cases)
+
+    def lineage(self):
+        nodes = []
+        node = self
+        while node is not None:
+            nodes.append(node)
+            node = node.parent
+        return nodes[::-1]
+
+    @property
+    def name(self):
+        nodes = self.lineage()
+        return nodes[0].root_name + "".join(
+            f"_{BRANCH_CODES[node.branch]}{node.step}" for node in nodes[1:]
+        )
+
+    @property
+    def label_path(self):
+        return [node.label for node in self.lineage()]
+
+    @property
+    def order_path(self):
+        return [node.branch for node in self.lineage()[1:]]
+
+    def split(self, in_query, label, step):
+        """
+        Split into the passing (F) and complement (C) child, given a boolean
+        mask aligned with self.cases.
+        """
+        return (
+            SubsetNode(self, f"{label} ✔", FILTERED_BRANCH, step, self.cases[in_query], self.is_main_path),
+            SubsetNode(self, f"{label} ✘", COMPLEMENT_BRANCH, step, self.cases[~in_query], False)
+        )
+
+    def events(self, case_table):
+        return case_table.events(self.cases)
+
+    def copy(self, parent=None):
+        """
+        Copy of the subtree below this node. Case arrays and stats are
+        shared (and replaced, never modified), the nodes themselves are not.
+        """
+        node = SubsetNode(parent, self.label, self.branch, self.step, self.cases, self.is_main_path, self.root_name)
+        node.stats = self.stats
+        node.sketch = self.sketch
+        node.moments = self.moments
+        if self.children:
+            node.children = [child.copy(node) for child in self.children]
+        return node
+
+class PeakMemory:
+    """
+    Context manager recording the peak memory allocated, as traced by
+    tracemalloc, while it is active.
+    """
+
+    def __init__(self):
+        self.peak_bytes = 0
+
+    def __enter__(self):
+        self._was_tracing = tracemalloc.is_tracing()
+        if not self._was_tracing:
+            tracemalloc.start()
+        self._baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.peak_bytes = tracemalloc.get_traced_memory()[1] - self._baseline
+        if not self._was_tracing:
+            tracemalloc.stop()
+        return False
+
+class Profile:
+    """
+    Instrumentation of one chart call: wall time per stage, query evaluator
+    calls and the event rows they processed, cache hits and misses, and with
+    track_memory=True the peak traced memory of every stage.
+
+    Pass one as profile= to a chart function to have it filled in, export it
+    with to_dict() / to_json(), or receive it through a callback.
+    """
+
+    def __init__(self, track_memory=False, callback=None):
+        self.name = None
+        self.track_memory = track_memory
+        self.callback = callback
+        self.stages = {}
+        self.stage_peak_bytes = {}
+        self.total_seconds = None
+        self.evaluate_calls = 0
+        self.rows_evaluated = 0
+        self.cache_hits = {}
+        self.cache_misses = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        memory = PeakMemory() if self.track_memory else contextlib.nullcontext()
+        start = time.perf_counter()
+        try:
+            with memory:
+                yield self
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+            if self.track_memory:
+                self.stage_peak_bytes[name] = max(self.stage_peak_bytes.get(name, 0), memory.peak_bytes)
+
+    @property
+    def peak_memory_bytes(self):
+        return max(self.stage_peak_bytes.values()) if self.stage_peak_bytes else None
+
+    def record_evaluation(self, num_rows, num_calls=1):
+        self.evaluate_calls += num_calls
+        self.rows_evaluated += num_rows
+
+    def record_cache(self, cache, hit):
+        counts = self.cache_hits if hit else self.cache_misses
+        counts[cache] = counts.get(cache, 0) + 1
+
+    def cache_hit_rates(self):
+        rates = {}
+        for cache in set(self.cache_hits) | set(self.cache_misses):
+            hits = self.cache_hits.get(cache, 0)
+            rates[cache] = hits / (hits + self.cache_misses.get(cache, 0))
+        return rates
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "stages": dict(self.stages),
+            "total_seconds": self.total_seconds,
+            "evaluate_calls": self.evaluate_calls,
+            "rows_evaluated": self.rows_evaluated,
+            "cache_hits": dict(self.cache_hits),
+            "cache_misses": dict(self.cache_misses),
+            "cache_hit_rates": self.cache_hit_rates(),
+            "stage_peak_bytes": dict(self.stage_peak_bytes),
+            "peak_memory_bytes": self.peak_memory_bytes
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def report(self):
+        print("\n--- Execution Time (seconds) ---")
+        for name, seconds in self.stages.items():
+            print(f"{name:25}: {seconds:.4f}")
+        print(f"{'total':25}: {self.total_seconds or 0.0:.4f}")
+        print(f"\nQuery evaluations: {self.evaluate_calls} ({self.rows_evaluated:,} rows)")
+        for cache, rate in sorted(self.cache_hit_rates().items()):
+            print(f"Cache {cache}: {rate:.0%} hits")
+
+# Profile of the chart call in progress, so helpers can record into it
+_active_profile = contextvars.ContextVar("filter_visualization_profile", default=None)
+_profile_callback = None
+
+def set_profile_callback(callback):
+    """
+    Call callback(profile) after every chart call, e.g. to log profiles in a
+    pipeline. Pass None to stop.
+    """
+    global _profile_callback
+    _profile_callback = callback
+
+@contextlib.contextmanager
+def _profiled(name, profile=None):
+    profile = Profile() if profile is None else profile
+    profile.name = name
+    token = _active_profile.set(profile)
+    start = time.perf_counter()
+    try:
+        yield profile
+    finally:
+        profile.total_seconds = time.perf_counter() - start
+        _active_profile.reset(token)
+
+    for callback in (profile.callback, _profile_callback):
+        if callback is not None:
+            callback(profile)
+
+def _record_evaluation(num_rows, num_calls=1):
+    profile = _active_profile.get()
+    if profile is not None:
+        profile.record_evaluation(num_rows, num_calls)
+
+def _record_cache(cache, hit):
+    profile = _active_profile.get()
+    if profile is not None:
+        profile.record_cache(cache, hit)
+
+def evaluate_query(log_view, log_df, query_obj):
+    """
+    Run the log_view's query evaluator, recording the call in the active
+    profile. Queries of exported case sets select their cases directly.
+    """
+    _record_evaluation(len(log_df))
+    members = _case_set_members(query_obj)
+    if members is not None:
+        in_set = log_df["case:concept:name"].isin(members).to_numpy()
+        return log_df[in_set], log_df[~in_set]
+    return log_view.query_evaluator.evaluate(log_df, query_obj)
+
 def split_subsets(subsets, query_obj, filter_label, step_index, query_evaluator, filter_cache):
     new_subsets = []
 
@@ -205,195 +1844,735 @@ def split_subsets(subsets, query_obj, filter_label, step_index, query_evaluator,
 
     return new_subsets
 
-def recursively_apply_filters(selected_sequence_df, log_view, metric):
-    initial_log_name = selected_sequence_df.iloc[0]['source_log']
-    base_df = log_view.result_set_name_cache[initial_log_name]
-
-    if metric == "avg_case_duration_seconds":
-        initial_df = add_case_durations(base_df)
-    elif metric == "avg_events_per_case":
-        initial_df = add_event_counts(base_df)
-    elif metric == "avg_time_between_events":
-        initial_df = add_avg_time_between_events(base_df)
-    else:
-        raise ValueError(f"Unsupported metric: {metric}")
-
-    main_path_leaf = None
-
-    current_subsets = [{
-        "df": initial_df,
-        "name": initial_log_name,
-        "label_path": ["Initial Source"],
-        "order_path": [],
-        "is_main_path": True
-    }]
-
-    filter_cache = {}
-
-    query_map = {
-        evaluation["query"].name: evaluation["query"]
-        for result_set_id in log_view.query_registry.get_registered_result_set_ids()
-        for evaluation in [log_view.query_registry.get_evaluation(result_set_id)]
-    }
+def _lineage_steps(lineage_df, log_view):
+    # (query, label, step number) for every row of a lineage
+    catalog = get_query_catalog(log_view)
+    steps = []
+    for i, row in lineage_df.iterrows():
+        expression = catalog.expression_for(row)
+        steps.append((catalog.query_for(row), row["labels"] if expression is None else expression, i + 1))
+    return steps
+
+def _same_steps(steps, other):
+    # Lineage steps are the same when they run the same query objects under the same labels
+    return len(steps) == len(other) and all(
+        step[0] is step_other[0] and step[1] == step_other[1] for step, step_other in zip(steps, other)
+    )
 
-    query_expression_map = {
-        evaluation["query"].name: evaluation["query"].as_string()
-        for result_set_id in log_view.query_registry.get_registered_result_set_ids()
-        for evaluation in [log_view.query_registry.get_evaluation(result_set_id)]
-    }
+class FilterTree:
+    """
+    Tree of the subsets produced by the steps of a lineage. Every node splits
+    into the cases passing (F) and failing (C) the next step; nodes are only
+    split when expanded.
+
+    Nodes with fewer than min_cases cases and nodes at max_depth are not split.
+    When a whole level is expanded only its top_n largest nodes are split.
+    Children left unsplit by min_cases or top_n are folded into a single
+    "Other" node under their parent, except for the main path node, which
+    is kept (unsplit if too small) so the final result stays marked.
+
+    With sample_size set the tree is built on a seeded, stratified sample
+    of the cases (see CaseSample) and node stats are estimates with
+    confidence intervals; min_cases then applies to estimated case counts.
+    """
 
-    for i, row in selected_sequence_df.iterrows():
-        query_obj = query_map.get(row["query"])
-        query_expr = query_expression_map.get(row["query"], row["labels"])
-        next_subsets = []
+    def __init__(self, lineage_df, log_view, split_mode="case_sets", min_cases=1, max_depth=None, top_n=None, n_jobs=1,
+                 sample_size=None, seed=0):
+        if split_mode not in ("case_sets", "evaluate"):
+            raise ValueError(f"Unsupported split mode: {split_mode}")
+        if top_n is not None and top_n < 1:
+            raise ValueError("top_n must be at least 1.")
+        n_jobs = resolve_n_jobs(n_jobs)
+        if n_jobs > 1 and split_mode != "case_sets":
+            raise ValueError("n_jobs requires split_mode='case_sets'.")
+
+        self.log_view = log_view
+        self.split_mode = split_mode
+        self.min_cases = max(min_cases, 1)
+        self.top_n = top_n
+        self.result_set_name = lineage_df.iloc[-1]["result_set"]
+
+        initial_log_name = lineage_df.iloc[0]['source_log']
+        self.base_df = log_view.result_set_name_cache[initial_log_name]
+        self.sample = None
+        self.case_scale = 1
+        if sample_size is not None:
+            self.sample = get_case_sample(self.base_df, sample_size, seed)
+            self.base_df = self.sample.log_df
+            self.case_scale = self.sample.scale
+
+        self.steps = _lineage_steps(lineage_df, log_view)
+        self.depth_limit = max_depth
+        self.max_depth = len(self.steps) if max_depth is None else min(max_depth, len(self.steps))
+
+        # All subsets are case positions over one shared table of the initial source log
+        self._passing = {}
+        self._evaluate_upfront(0, n_jobs)
+        self.case_table = get_case_table(self.base_df)
+        if self.sample is not None:
+            self._strata = self.sample.strata_of(self.case_table.case_metrics.index)
+
+        self.root = SubsetNode(
+            None, "Initial Source", None, None, np.arange(len(self.case_table)), True, root_name=initial_log_name
+        )
+        # Bumped on every change to the tree shape, invalidates the leaf frame
+        self._version = 0
+        self._leaf_frame = None
+
+    def _evaluate_upfront(self, first_depth, n_jobs):
+        # In parallel every step within max_depth is evaluated up front, in one pool
+        if n_jobs > 1:
+            queries = [query_obj for query_obj, _, _ in self.steps[first_depth:self.max_depth]]
+            step_codes = evaluate_case_codes_batch(self.log_view, self.base_df, queries, n_jobs)
+            num_cases = len(get_case_metrics(self.base_df))
+            for depth, case_codes in enumerate(step_codes, first_depth):
+                passing = np.zeros(num_cases, dtype=bool)
+                passing[case_codes] = True
+                self._passing[depth] = passing
+
+    def _bitmap(self, case_codes):
+        # Bitmap over all cases of the initial source log
+        passing = np.zeros(len(self.case_table), dtype=bool)
+        passing[case_codes] = True
+        return passing
+
+    def _passing_cases(self, depth):
+        # Evaluated on first use
+        if depth not in self._passing:
+            query_obj = self.steps[depth][0]
+            self._passing[depth] = self._bitmap(
+                evaluate_case_codes(self.log_view, self.base_df, query_obj, self.case_table.case_metrics)
+            )
+        return self._passing[depth]
+
+    def is_expandable(self, node):
+        return (
+            node.branch != OTHER_BRANCH
+            and node.depth < self.max_depth
+            and len(node) * self.case_scale >= self.min_cases
+        )
 
-        for subset in current_subsets:
-            df = subset["df"]
-            if df.empty:
+    def _fold(self, parent, nodes):
+        cases = np.sort(np.concatenate([node.cases for node in nodes]))
+        return SubsetNode(parent, "Other", OTHER_BRANCH, nodes[0].step, cases, False)
+
+    def expand(self, node=None):
+        """
+        Split a node (the root by default) and return its non-empty children.
+        """
+        node = self.root if node is None else node
+        if node.children is not None:
+            return node.children
+        if not self.is_expandable(node):
+            node.children = []
+            return node.children
+
+        query_obj, label, step = self.steps[node.depth]
+        if self.split_mode == "case_sets":
+            in_query = self._passing_cases(node.depth)[node.cases]
+        else:
+            session_cache = get_session_cache(self.log_view)
+            session_key = (normalize_query_expression(query_obj), subset_identity(self.base_df, node.cases))
+            passing_cases = session_cache.get(session_key)
+            if passing_cases is None:
+                # The evaluator needs raw events, the slice is dropped right after
+                df_filtered, _ = evaluate_query(self.log_view, node.events(self.case_table), query_obj)
+                passing_cases = self.case_table.case_codes(df_filtered["case:concept:name"])
+                session_cache.put(session_key, passing_cases)
+            in_query = np.isin(node.cases, passing_cases)
+
+        children = [child for child in node.split(in_query, label, step) if len(child) > 0]
+        # The main path child is never folded, so the final result stays marked
+        small = [
+            child for child in children if len(child) * self.case_scale < self.min_cases and not child.is_main_path
+        ]
+        if small:
+            children = [child for child in children if child not in small]
+            children.append(self._fold(node, small))
+
+        node.children = children
+        self._version += 1
+        return children
+
+    def _fold_beyond_top_n(self, level):
+        """
+        Fold the nodes of a level that are not among its top_n largest
+        expandable nodes into the "Other" node of their parent, and return
+        the updated level.
+        """
+        expandable = [node for node in level if self.is_expandable(node)]
+        if self.top_n is None or len(expandable) <= self.top_n:
+            return level
+
+        folded = set(node for node in sorted(expandable, key=len, reverse=True)[self.top_n:] if not node.is_main_path)
+        parents = list(dict.fromkeys(node.parent for node in level))
+        for parent in parents:
+            merged = [child for child in parent.children if child in folded or child.branch == OTHER_BRANCH]
+            if any(child in folded for child in merged):
+                kept = [child for child in parent.children if child not in merged]
+                parent.children = kept + [self._fold(parent, merged)]
+                self._version += 1
+
+        return [child for parent in parents for child in parent.children]
+
+    def expand_all(self, progress=None, cancel_event=None):
+        """
+        Expand the tree level by level as far as the limits allow.
+
+        progress(step, num_steps, subsets_done, num_subsets) is called after
+        every subset split at each lineage step. Setting cancel_event (a
+        threading.Event) stops the build with a CancelledError before the
+        next split.
+        """
+        level = [self.root]
+        while level:
+            level = self._fold_beyond_top_n(level)
+            next_level = []
+            for i, node in enumerate(level):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise CancelledError(f"Building the tree of {self.result_set_name} was cancelled.")
+                next_level.extend(self.expand(node))
+                if progress is not None and node.depth < self.max_depth:
+                    progress(node.depth + 1, self.max_depth, i + 1, len(level))
+            level = next_level
+        return self
+
+    def find(self, name):
+        """
+        Node with the given name (e.g. "<initial log>_F1_C2"), expanding
+        the nodes along its path.
+        """
+        node = self.root
+        while node.name != name:
+            node = next(
+                (child for child in self.expand(node) if name == child.name or name.startswith(child.name + "_")),
+                None
+            )
+            if node is None:
+                raise KeyError(name)
+        return node
+
+    def leaves(self):
+        """
+        Non-empty nodes that are not (yet) split, in depth-first order.
+        """
+        leaves = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(reversed(node.children))
+            elif len(node) > 0:
+                leaves.append(node)
+        return leaves
+
+    def main_path_leaf(self):
+        return next((leaf for leaf in self.leaves() if leaf.is_main_path), None)
+
+    def aggregate(self, nodes):
+        """
+        Fill in the stats (case count, the mean of every metric and the
+        quantile metrics) of the given nodes in one pass over the case metric
+        table.
+        """
+        pending = [node for node in nodes if node.stats is None]
+        if not pending:
+            return
+
+        cases = np.concatenate([node.cases for node in pending])
+        groups = np.repeat(np.arange(len(pending)), [len(node) for node in pending])
+        values = self.case_table.metric_values()[cases]
+        if self.sample is not None:
+            stats = _sampled_group_stats(groups, len(pending), self._strata[cases], values, self.sample)
+        else:
+            stats = {"num_cases": [len(node) for node in pending]}
+            moments = np.zeros((len(pending), 2, len(METRIC_COLUMNS)))
+            for j, metric in enumerate(METRIC_COLUMNS):
+                moments[:, 0, j], moments[:, 1, j] = _group_moments(groups, values[:, j], len(pending))
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    stats[metric] = moments[:, 1, j] / moments[:, 0, j]
+            for node, node_moments in zip(pending, moments):
+                node.moments = node_moments
+
+        self._sketch(pending)
+        first_bins = self.case_table.sketch_bins()[1]
+        stats.update(_sketch_quantiles(np.stack([node.sketch for node in pending]), first_bins))
+        if self.sample is not None:
+            # Sketch quantiles come without confidence intervals
+            stats.update({f"{metric}_ci": np.full(len(pending), np.nan) for metric in QUANTILE_METRICS})
+
+        for i, node in enumerate(pending):
+            node.stats = {key: column[i] for key, column in stats.items()}
+
+    def _sketch(self, nodes):
+        # Sketches of leaves come from their cases, in one pass; parents merge their children's
+        order = []
+        leaves = []
+        stack = [node for node in nodes if node.sketch is None]
+        while stack:
+            node = stack.pop()
+            if node.sketch is not None:
                 continue
-
-            path = subset["label_path"]
-            order_path = subset["order_path"]
-            is_main = subset["is_main_path"]
-
-            cache_key = (subset["name"], query_obj.name)
-            if cache_key in filter_cache:
-                df_filtered, df_complement = filter_cache[cache_key]
+            order.append(node)
+            if node.children:
+                stack.extend(node.children)
             else:
-                df_filtered, df_complement = log_view.query_evaluator.evaluate(df, query_obj)
-                filter_cache[cache_key] = (df_filtered, df_complement)
-
-            next_subsets.append({
-                "df": df_filtered,
-                "name": f"{subset['name']}_F{i+1}",
-                "label_path": path + [f"{query_expr} ✔"],
-                "order_path": order_path + [0],
-                "is_main_path": is_main
-            })
-            next_subsets.append({
-                "df": df_complement,
-                "name": f"{subset['name']}_C{i+1}",
-                "label_path": path + [f"{query_expr} ✘"],
-                "order_path": order_path + [1],
-                "is_main_path": False
-            })
-
-        current_subsets = next_subsets
-
-    for subset in current_subsets:
-        if subset["is_main_path"] and not subset["df"].empty:
-            main_path_leaf = subset
-            break
-
-    main_path_label_set = set()
-    if main_path_leaf:
-        for i in range(len(main_path_leaf["label_path"])):
-            main_path_label_set.add(tuple(main_path_leaf["label_path"][:i + 1]))
-
-    result_rows = []
-    for subset in current_subsets:
-        df = subset["df"]
-        if df.empty:
-            continue
+                leaves.append(node)
+
+        if leaves:
+            bins, _, width = self.case_table.sketch_bins()
+            cases = np.concatenate([leaf.cases for leaf in leaves])
+            groups = np.repeat(np.arange(len(leaves)), [len(leaf) for leaf in leaves])
+            weights = None
+            if self.sample is not None:
+                weights = (self.sample.stratum_sizes / self.sample.stratum_samples)[self._strata[cases]]
+            sketches = _group_sketches(groups, len(leaves), bins[cases], width, weights)
+            for leaf, sketch in zip(leaves, sketches):
+                leaf.sketch = sketch
+
+        # Children come after their parent in order
+        for node in reversed(order):
+            if node.children:
+                node.sketch = sum(child.sketch for child in node.children)
+
+    def _leaves_frame(self):
+        # Leaf rows with every metric, rebuilt only when the tree has changed
+        if self._leaf_frame is not None and self._leaf_frame[0] == self._version:
+            return self._leaf_frame[1:]
+
+        leaves = self.leaves()
+        self.aggregate(leaves)
+        main_path_leaf = next((leaf for leaf in leaves if leaf.is_main_path), None)
+        main_path_nodes = set(map(id, main_path_leaf.lineage())) if main_path_leaf else set()
+
+        result_rows = []
+        for leaf in leaves:
+            display_path = [
+                "🟡 " + node.label if id(node) in main_path_nodes else node.label
+                for node in leaf.lineage()
+            ]
+            row = {
+                **{f"Level{i+1}": label for i, label in enumerate(display_path)},
+                **leaf.stats,
+                "order_path": leaf.order_path
+            }
+            result_rows.append(row)
+
+        result_df = pd.DataFrame(result_rows)
+        result_df = result_df.sort_values(by="order_path")
+        main_path = main_path_leaf.label_path if main_path_leaf else []
+
+        self._leaf_frame = (self._version, result_df, main_path)
+        return result_df, main_path
+
+    def to_frame(self, metric):
+        """
+        One row per leaf with its Level1..LevelN labels, case count and
+        metric, plus the label path of the main path leaf. All metrics are
+        aggregated together, so switching metrics does not recompute anything.
+        Sampled trees add num_cases_ci and <metric>_ci columns.
+        """
+        if metric not in ALL_METRICS:
+            raise ValueError(f"Unsupported metric: {metric}")
+
+        leaves_df, main_path = self._leaves_frame()
+        other_metrics = [other for other in ALL_METRICS if other != metric]
+        other_metrics += [f"{other}_ci" for other in other_metrics]
+        return leaves_df.drop(columns=other_metrics, errors="ignore"), list(main_path)
+
+    def to_nodes(self):
+        """
+        One row per non-empty node, parents before children, with its id
+        (the node name), parent id, display label, case count and every
+        metric (and their confidence intervals for sampled trees). Suited to
+        go.Icicle, which needs no re-aggregation then.
+        """
+        nodes = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            if node.children:
+                stack.extend(reversed([child for child in node.children if len(child) > 0]))
+        self.aggregate(nodes)
+
+        main_path_leaf = self.main_path_leaf()
+        main_path_nodes = set(map(id, main_path_leaf.lineage())) if main_path_leaf else set()
+        names = [node.name for node in nodes]
+        name_of = dict(zip(map(id, nodes), names))
+
+        return pd.DataFrame({
+            "id": names,
+            "parent": [name_of[id(node.parent)] if node.parent is not None else "" for node in nodes],
+            "label": ["🟡 " + node.label if id(node) in main_path_nodes else node.label for node in nodes],
+            "depth": [node.depth for node in nodes],
+            **{key: [node.stats[key] for node in nodes] for key in self.root.stats},
+            "is_leaf": [not node.children for node in nodes]
+        })
 
-        label_path = subset["label_path"]
-        display_path = []
+    def extended(self, lineage_df, n_jobs=1):
+        """
+        Unexpanded copy of this tree for a lineage that continues its own
+        one, e.g. the lineage of a child result set. Its nodes are copies of
+        this tree's nodes, so expand_all() only splits the current leaves by
+        the new steps. Returns None when lineage_df does not start with this
+        tree's steps.
+        """
+        steps = _lineage_steps(lineage_df, self.log_view)
+        if len(steps) < len(self.steps) or any(new[0] is not old[0] for new, old in zip(steps, self.steps)):
+            return None
+
+        tree = copy.copy(self)
+        tree.steps = steps
+        tree.result_set_name = lineage_df.iloc[-1]["result_set"]
+        tree.max_depth = len(steps) if self.depth_limit is None else min(self.depth_limit, len(steps))
+        tree.root = self.root.copy()
+        tree._passing = dict(self._passing)
+        tree._version = 0
+        tree._leaf_frame = None
+
+        # Leaves at the old depth limit were closed with no children, reopen them
+        stack = [tree.root]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children)
+            elif node.depth == self.max_depth:
+                node.children = None
+
+        if tree.split_mode == "case_sets":
+            tree._evaluate_upfront(self.max_depth, n_jobs)
+        return tree
+
+    def is_current(self, lineage_df=None):
+        """
+        Whether the tree still matches the initial source log held by its
+        log_view and, given the current lineage of its result set, the steps
+        of that lineage (a result set registered again with another query
+        changes them).
+        """
+        return (
+            self.log_view.result_set_name_cache[self.root.root_name] is self.base_df
+            and get_case_table(self.base_df) is self.case_table
+            and (lineage_df is None or _same_steps(_lineage_steps(lineage_df, self.log_view), self.steps))
+        )
 
-        for i in range(len(label_path)):
-            path_prefix = tuple(label_path[:i + 1])
-            if path_prefix in main_path_label_set:
-                display_path.append("🟡 " + label_path[i])
-            else:
-                display_path.append(label_path[i])
-
-        stats = compute_case_stats(df, subset["name"], display_path, metric)
-        row = {
-            **{f"Level{i+1}": label for i, label in enumerate(display_path)},
-            "num_cases": stats["num_cases"],
-            metric: stats[metric],
-            "order_path": subset["order_path"]
-        }
-        result_rows.append(row)
+    def case_set(self, node=None):
+        """
+        CaseSet of a node (the root by default), given as the node or its
+        name, e.g. an id of to_nodes().
+        """
+        if isinstance(node, str):
+            node = self.find(node)
+        node = self.root if node is None else node
+        return CaseSet(self.case_table, node.cases)
+
+    def supports_append(self):
+        """
+        Whether append_events() can update the tree in place. Sampled trees,
+        "evaluate" trees and trees pruned by min_cases or top_n are rebuilt
+        instead.
+        """
+        return self.split_mode == "case_sets" and self.sample is None and self.min_cases == 1 and self.top_n is None
+
+    def _apply_append(self, log_df, case_table, passing, affected):
+        """
+        Rebase the tree on log_df and its case_table, which extends the
+        tree's own one, given the query results of every evaluated step on
+        it. The affected cases (positions in case_table) are moved to the
+        nodes their new query results put them in. Aggregated nodes on the
+        way have their moments and sketches adjusted by the removed and added
+        cases only; nodes that did not exist before are split and aggregated
+        on first use like any other.
+        """
+        old_table, old_passing = self.case_table, self._passing
+        old_values, new_values = old_table.metric_values(), case_table.metric_values()
+        old_bins, first_bins, _ = old_table.sketch_bins()
+        new_bins, new_first_bins, width = case_table.sketch_bins()
+        self.base_df, self.case_table, self._passing = log_df, case_table, passing
+
+        nodes = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(node.children or [])
+        if new_first_bins != first_bins:
+            # The cases were binned anew, so the sketches are rebuilt from scratch
+            for node in nodes:
+                node.stats = node.sketch = node.moments = None
+
+        def delta(bins, values, cases):
+            groups = np.zeros(len(cases), dtype=np.int64)
+            moments = np.array([_group_moments(groups, values[cases, j], 1) for j in range(values.shape[1])])
+            return _group_sketches(groups, 1, bins[cases], width)[0], moments[:, :, 0].T
+
+        def move(node, removed, added):
+            # Sorted inserts and deletes, without re-sorting the node's cases
+            cases = np.delete(node.cases, np.searchsorted(node.cases, removed))
+            node.cases = np.insert(cases, np.searchsorted(cases, added), added)
+            if node.sketch is not None:
+                removed_sketch, removed_moments = delta(old_bins, old_values, removed)
+                added_sketch, added_moments = delta(new_bins, new_values, added)
+                sketch = np.pad(node.sketch, ((0, 0), (0, width - node.sketch.shape[1])))
+                node.sketch = sketch - removed_sketch + added_sketch
+                if node.stats is not None:
+                    node.moments = node.moments - removed_moments + added_moments
+                    with np.errstate(invalid="ignore", divide="ignore"):
+                        means = node.moments[1] / node.moments[0]
+                    quantiles = _sketch_quantiles(node.sketch[None], new_first_bins)
+                    node.stats = {
+                        "num_cases": len(node),
+                        **dict(zip(METRIC_COLUMNS, means)),
+                        **{metric: values[0] for metric, values in quantiles.items()}
+                    }
+            if not node.children:
+                return
+
+            _, label, step = self.steps[node.depth]
+            was_passing = old_passing[node.depth][removed]
+            is_passing = passing[node.depth][added]
+            children = {child.branch: child for child in node.children}
+            for branch, in_branch in ((FILTERED_BRANCH, True), (COMPLEMENT_BRANCH, False)):
+                child_removed = removed[was_passing == in_branch]
+                child_added = added[is_passing == in_branch]
+                child = children.get(branch)
+                if child is None and len(child_added) > 0:
+                    mark = "✔" if in_branch else "✘"
+                    child = children[branch] = SubsetNode(
+                        node, f"{label} {mark}", branch, step, child_added[:0], node.is_main_path and in_branch
+                    )
+                    created.append(child)
+                if child is not None:
+                    move(child, child_removed, child_added)
+            node.children = [
+                children[branch] for branch in (FILTERED_BRANCH, COMPLEMENT_BRANCH)
+                if branch in children and len(children[branch]) > 0
+            ]
 
-    result_df = pd.DataFrame(result_rows)
-    result_df = result_df.sort_values(by="order_path")
+        created = []
+        move(self.root, affected[affected < len(old_table)], affected)
+        for node in created:
+            stack = [node]
+            while stack:
+                stack.extend(self.expand(stack.pop()))
+        self._version += 1
+
+    def show(self, metric="avg_case_duration_seconds", details=True):
+        """
+        Render the part of the tree expanded so far as an icicle chart.
+        """
+        icicle_df, main_path = self.to_frame(metric)
+        _render_icicle(icicle_df, main_path, metric, self.result_set_name, details)
+
+def recursively_apply_filters(selected_sequence_df, log_view, metric, split_mode="case_sets", min_cases=1, max_depth=None, top_n=None, n_jobs=1):
+    """
+    Split the initial source log along every step of a lineage, keeping both
+    the passing (F) and the complement (C) branch at each step.
+
+    With split_mode="case_sets" every query is evaluated once on the initial
+    source log and all branches are derived from the passing case positions
+    by intersection and difference. This relies on queries selecting whole
+    cases, which holds for logview predicates. split_mode="evaluate" runs the
+    query evaluator on the events of every subset instead.
+
+    Subsets are kept as case positions over the initial source log and event
+    frames are only materialized for the evaluator in "evaluate" mode.
+    min_cases, max_depth and top_n limit the expansion, see FilterTree.
+    n_jobs > 1 evaluates the queries on case-hash shards of the log in a
+    process pool, with identical results.
+    """
+    if metric not in ALL_METRICS:
+        raise ValueError(f"Unsupported metric: {metric}")
 
-    return result_df, main_path_leaf["label_path"] if main_path_leaf else []
+    tree = get_filter_tree(selected_sequence_df, log_view, split_mode, min_cases, max_depth, top_n, n_jobs)
+    return tree.to_frame(metric)
 
-def query_exploration_icicle(result_set_name, log_view, metric="avg_case_duration_seconds", show_time=False, details=True):
+# Fully expanded filter trees keyed by id() of their log_view
+_filter_trees = {}
 
-    def format_seconds(seconds):
-        if pd.isna(seconds):
-            return "N/A"
-        seconds = int(seconds)
-        days, rem = divmod(seconds, 86400)
-        hours, rem = divmod(rem, 3600)
-        minutes = rem // 60
-        parts = []
-        if days: parts.append(f"{days}d")
-        if hours: parts.append(f"{hours}h")
-        if minutes: parts.append(f"{minutes}m")
-        return " ".join(parts) if parts else "0m"
+def get_filter_tree(lineage_df, log_view, split_mode="case_sets", min_cases=1, max_depth=None, top_n=None, n_jobs=1,
+                    progress=None, cancel_event=None):
+    """
+    Fully expanded FilterTree of a lineage, cached per log_view, result set
+    and pruning settings. Trees built on a log that has since been replaced,
+    or on steps the lineage no longer has, are rebuilt.
 
-    times = {}
-    start_all = time.time()
+    When the tree of the parent result set is cached, the tree is built from
+    it by splitting only the parent tree's leaves with the new step.
+    progress and cancel_event are passed to FilterTree.expand_all.
+    """
+    # The lock only guards lookups and inserts, trees are built outside of it
+    key = (lineage_df.iloc[-1]["result_set"], split_mode, max(min_cases, 1), max_depth, top_n)
+    with _cache_lock:
+        trees = _get_attached(_filter_trees, log_view)
+        if trees is None:
+            trees = _attach(_filter_trees, log_view, {})
+        tree = trees.get(key)
+        parent_tree = trees.get((lineage_df.iloc[-2]["result_set"],) + key[1:]) if len(lineage_df) > 1 else None
+
+    if tree is not None and tree.is_current(lineage_df):
+        _record_cache("filter_trees", True)
+        return tree
+
+    _record_cache("filter_trees", False)
+    if parent_tree is not None and parent_tree.is_current(lineage_df.iloc[:-1]):
+        tree = parent_tree.extended(lineage_df, n_jobs)
+    else:
+        tree = None
+    if tree is None:
+        tree = FilterTree(lineage_df, log_view, split_mode, min_cases, max_depth, top_n, n_jobs)
+    tree.expand_all(progress, cancel_event)
+    with _cache_lock:
+        trees[key] = tree
+    return tree
+
+def icicle_case_set(result_set_name, log_view, node_id, split_mode="case_sets", min_cases=1, max_depth=None, top_n=None,
+                    n_jobs=1):
+    """
+    CaseSet of one node of a result set's icicle chart, given its id (the
+    "id" column of the headless chart data, e.g. "Initial Source Log_F1_C2").
+    The tree is the cached one of the same settings, built if needed.
+    """
+    lineage_df = get_query_catalog(log_view).lineage(result_set_name)
+    if len(lineage_df) < 1:
+        raise ValueError("Lineage not found.")
+    tree = get_filter_tree(lineage_df, log_view, split_mode, min_cases, max_depth, top_n, n_jobs)
+    return tree.case_set(node_id)
 
-    # Get lineage
-    t0 = time.time()
-    lineage = get_lineage(log_view.query_registry.summary(), result_set_name)
-    times['lineage'] = time.time() - t0
+def _initial_source_log(log_view, result_set_name):
+    # The initial source log as held by the log_view, which append_events() replaces
+    lineage_df = get_query_catalog(log_view).lineage(result_set_name)
+    if len(lineage_df) < 1:
+        return log_view.query_registry.get_initial_source_log()
+    return log_view.result_set_name_cache[lineage_df.iloc[0]["source_log"]]
 
-    # Compute filtered subsets and stats
-    t1 = time.time()
-    icicle_df, main_path = recursively_apply_filters(lineage, log_view, metric=metric)
+def append_events(log_view, new_events, source_log_name=None):
+    """
+    Append a batch of new events to the initial source log of a log_view and
+    bring the cached state built on it up to date, touching only the cases
+    the new events belong to:
+
+    - their rows of the case metric table are recomputed, new cases are
+      added at the end of it;
+    - every query with a cached result on the log (session cache and filter
+      tree steps) is evaluated on the events of these cases only and its
+      result is updated by difference;
+    - cached filter trees move these cases between their nodes and adjust
+      the stats of the nodes on the way by delta (see
+      FilterTree.supports_append; other trees are dropped and rebuilt on
+      next use).
+
+    source_log_name is needed when the registry has several initial source
+    logs. Result sets derived from the log are not re-evaluated. Returns the
+    new log, which replaces the old one in log_view.result_set_name_cache.
+    """
+    with _cache_lock:
+        catalog = get_query_catalog(log_view)
+        if source_log_name is None:
+            roots = {parent for parent in catalog.parents.values() if parent not in catalog.parents}
+            if len(roots) != 1:
+                raise ValueError("source_log_name is required unless there is exactly one initial source log.")
+            source_log_name = roots.pop()
+
+        old_log = log_view.result_set_name_cache[source_log_name]
+        old_table = get_case_table(old_log)
+        log_df = pd.concat([old_log, new_events], ignore_index=True)
+        case_table, affected = old_table.appended(log_df, new_events)
+        _attach(_case_metrics_cache, log_df, (len(log_df), case_table.case_metrics))
+        _attach(_case_tables, log_df, case_table)
+
+        trees = _get_attached(_filter_trees, log_view) or {}
+        updated_trees = []
+        for key, tree in list(trees.items()):
+            if tree.base_df is not old_log:
+                continue
+            if tree.supports_append() and tree.case_table is old_table:
+                updated_trees.append(tree)
+            else:
+                del trees[key]
+
+        # Every query with a result on the old log, with that result as a bitmap
+        session_cache = get_session_cache(log_view)
+        old_id = subset_identity(old_log)
+        queries_by_expression = {normalize_query_expression(q): q for q in catalog.result_set_queries.values()}
+        old_results = {}
+        for (expression, subset_id), case_codes in session_cache.items():
+            if subset_id == old_id and expression in queries_by_expression:
+                bitmap = np.zeros(len(old_table), dtype=bool)
+                bitmap[case_codes] = True
+                old_results[expression] = (queries_by_expression[expression], bitmap)
+        for tree in updated_trees:
+            for depth, bitmap in tree._passing.items():
+                query_obj = tree.steps[depth][0]
+                old_results.setdefault(normalize_query_expression(query_obj), (query_obj, bitmap))
+
+        affected_events = case_table.events(affected)
+        affected_index = pd.Index(case_table.case_ids(affected))
+        new_id = subset_identity(log_df)
+        bitmaps = {}
+        for expression, (query_obj, old_bitmap) in old_results.items():
+            df_filtered, _ = evaluate_query(log_view, affected_events, query_obj)
+            bitmap = np.zeros(len(case_table), dtype=bool)
+            bitmap[:len(old_bitmap)] = old_bitmap
+            bitmap[affected] = False
+            bitmap[affected[affected_index.get_indexer(pd.unique(df_filtered["case:concept:name"]))]] = True
+            session_cache.put((expression, new_id), np.flatnonzero(bitmap))
+            bitmaps[expression] = bitmap
+
+        for tree in updated_trees:
+            passing = {
+                depth: bitmaps[normalize_query_expression(tree.steps[depth][0])] for depth in tree._passing
+            }
+            tree._apply_append(log_df, case_table, passing, affected)
+
+        log_view.result_set_name_cache[source_log_name] = log_df
+        return log_df
+
+# Define color settings
+ICICLE_COLOR_SCHEMES = {
+    "avg_case_duration_seconds": "Blues",
+    "avg_events_per_case": "Reds",
+    "avg_time_between_events": "Greens",
+    "median_case_duration_seconds": "Blues",
+    "p90_case_duration_seconds": "Blues",
+    "p99_case_duration_seconds": "Blues",
+    "median_time_between_events": "Greens",
+    "p90_time_between_events": "Greens",
+    "p99_time_between_events": "Greens"
+}
+ICICLE_COLOR_LABELS = {
+    "avg_case_duration_seconds": "Avg Case Duration (s)",
+    "avg_events_per_case": "Avg Events per Case",
+    "avg_time_between_events": "Avg Time Between Events (s)",
+    "median_case_duration_seconds": "Median Case Duration (s)",
+    "p90_case_duration_seconds": "P90 Case Duration (s)",
+    "p99_case_duration_seconds": "P99 Case Duration (s)",
+    "median_time_between_events": "Median Time Between Events (s)",
+    "p90_time_between_events": "P90 Time Between Events (s)",
+    "p99_time_between_events": "P99 Time Between Events (s)"
+}
+
+def _render_icicle(icicle_df, main_path, metric, result_set_name, details):
+    import plotly.express as px
 
     # Filter to only final-level rows (leaves)
     path_cols = [col for col in icicle_df.columns if col.startswith("Level")]
     icicle_df["is_leaf"] = ~icicle_df.duplicated(subset=path_cols, keep=False)
 
     # Add hover label data only for leaves
-    hover_cases = []
-    hover_metric = []
-    for _, row in icicle_df.iterrows():
-        if row["is_leaf"]:
-            hover_cases.append(f"{row['num_cases']:,}")
-            if "duration" in metric or "time" in metric:
-                sec = row[metric]
-                d = int(sec // 86400)
-                h = int((sec % 86400) // 3600)
-                m = int((sec % 3600) // 60)
-                hover_metric.append(f"{d}d {h}h {m}m")
-            else:
-                hover_metric.append(f"{row[metric]:.2f}")
-        else:
-            hover_cases.append("")
-            hover_metric.append("")
-
-    icicle_df["hover_cases"] = hover_cases
-    icicle_df["hover_metric"] = hover_metric
-
-    times['apply_filters'] = time.time() - t1
-
-    # Define color settings
-    color_schemes = {
-        "avg_case_duration_seconds": "Blues",
-        "avg_events_per_case": "Reds",
-        "avg_time_between_events": "Greens"
-    }
-    color_labels = {
-        "avg_case_duration_seconds": "Avg Case Duration (s)",
-        "avg_events_per_case": "Avg Events per Case",
-        "avg_time_between_events": "Avg Time Between Events (s)"
-    }
+    is_leaf = icicle_df["is_leaf"].to_numpy(dtype=bool)
+    icicle_df["hover_cases"] = np.where(is_leaf, format_counts(icicle_df["num_cases"]), "")
+    icicle_df["hover_metric"] = np.where(is_leaf, format_metric_values(icicle_df[metric], metric), "")
 
     # Plot icicle
     fig = px.icicle(
         icicle_df,
-        path=[col for col in icicle_df.columns if col.startswith("Level")],
+        path=path_cols,
         values="num_cases",
         color=metric,
         custom_data=["hover_cases", "hover_metric"],
-        color_continuous_scale=color_schemes.get(metric, "Blues"),
+        color_continuous_scale=ICICLE_COLOR_SCHEMES.get(metric, "Blues"),
         title=f"Icicle Chart for: {result_set_name}"
     )
 
@@ -403,50 +2582,361 @@ def query_exploration_icicle(result_set_name, log_view, metric="avg_case_duratio
     # Update layout
     fig.update_layout(
         margin=dict(t=40, l=0, r=0, b=0),
-        coloraxis_colorbar=dict(title=color_labels.get(metric, metric))
+        coloraxis_colorbar=dict(title=ICICLE_COLOR_LABELS.get(metric, metric))
     )
 
     fig.show()
-    times['plot'] = time.time() - t1
-    times['total'] = time.time() - start_all
 
     if details:
-        print("\nSummary with Metrics:\n")
+        _print_icicle_summary(icicle_df, main_path, metric)
 
-        # Build final result path (without yellow dots)
-        final_result_path = " → ".join(main_path) if main_path else ""
+def _print_icicle_summary(icicle_df, main_path, metric):
+    print("\nSummary with Metrics:\n")
+    path_cols = [col for col in icicle_df.columns if col.startswith("Level")]
 
-        for _, row in icicle_df.iterrows():
-            # Extract path parts
-            path_parts = [
-                str(row[col]).replace("🟡 ", "") for col in path_cols if pd.notna(row[col])
-            ]
-            current_path = " → ".join(path_parts)
+    # Build final result path (without yellow dots)
+    final_result_path = " → ".join(main_path) if main_path else ""
 
-            # Check if this row is the final result
-            is_final_result = current_path == final_result_path
+    current_paths = join_path_columns(
+        icicle_df[path_cols].apply(lambda labels: labels.str.replace("🟡 ", ""))
+    )
 
-            path_with_emojis = current_path.replace("✔", "✅").replace("✘", "❌").replace("✓", "✅").replace("✗", "❌")
+    # Yellow dot only for the final row
+    prefixes = np.where(current_paths == final_result_path, "🟡 ", "").astype(object)
 
-            # Format the metric
-            if "duration" in metric or "time" in metric:
-                metric_val = format_seconds(row[metric])
-            else:
-                metric_val = f"{row[metric]:.2f}"
+    paths_with_emojis = (
+        current_paths.str.replace("✔", "✅").str.replace("✘", "❌")
+        .str.replace("✓", "✅").str.replace("✗", "❌")
+    )
+    counts = format_counts(icicle_df["num_cases"])
+    metric_vals = format_metric_values(icicle_df[metric], metric, compact=True)
 
-            # Yellow dot only for the final row
-            prefix = "🟡 " if is_final_result else ""
+    # Confidence intervals of sampled previews
+    if "num_cases_ci" in icicle_df:
+        counts = counts + format_margins(icicle_df["num_cases_ci"])
+        metric_vals = metric_vals + format_margins(icicle_df[f"{metric}_ci"], metric)
 
-            print(f"- {prefix}{int(row['num_cases']):,} cases ({path_with_emojis}) | {color_labels.get(metric, metric)}: {metric_val}")
+    lines = (
+        "- " + prefixes + counts + " cases ("
+        + paths_with_emojis.to_numpy(dtype=object) + f") | {ICICLE_COLOR_LABELS.get(metric, metric)}: " + metric_vals
+    )
+    if len(lines):
+        print("\n".join(lines))
 
+def _branch_totals(nodes_df):
+    """
+    Icicle values for branchvalues="total": the rounded case count of every
+    leaf, and the sum of its children's values for every other node. Plotly
+    drops branches whose children add up to more than the node, which
+    separately rounded estimates of sampled previews can do.
+    """
+    ids, parents = nodes_df["id"].tolist(), nodes_df["parent"].tolist()
+    is_leaf = ~nodes_df["id"].isin(nodes_df["parent"]).to_numpy()
+    counts = np.rint(nodes_df["num_cases"].to_numpy(dtype=float)).astype(np.int64)
+    totals = dict(zip(ids, np.where(is_leaf, counts, 0).tolist()))
+    # Parents come before their children, so in reverse order every subtree is summed before its parent
+    for node_id, parent in zip(reversed(ids), reversed(parents)):
+        if parent in totals:
+            totals[parent] += totals[node_id]
+    return [totals[node_id] for node_id in ids]
+
+def _icicle_figure(nodes_df, metric, result_set_name):
+    # Figure straight from precomputed ids and parents, see FilterTree.to_nodes
+    import plotly.graph_objects as go
+
+    colors = nodes_df[metric].to_numpy(dtype=float)
+
+    # Only sampled previews get hover labels, showing their confidence intervals
+    hover = dict(hoverinfo="skip")
+    if "num_cases_ci" in nodes_df:
+        hover = dict(
+            customdata=np.column_stack([
+                format_counts(nodes_df["num_cases"]) + format_margins(nodes_df["num_cases_ci"]),
+                format_metric_values(colors, metric, compact=True) + format_margins(nodes_df[f"{metric}_ci"], metric)
+            ]),
+            hovertemplate=(
+                "<b>%{label}</b><br>Cases: %{customdata[0]}<br>"
+                f"{ICICLE_COLOR_LABELS.get(metric, metric)}: " + "%{customdata[1]}<extra></extra>"
+            )
+        )
+
+    fig = go.Figure(go.Icicle(
+        ids=nodes_df["id"],
+        parents=nodes_df["parent"],
+        labels=nodes_df["label"],
+        values=_branch_totals(nodes_df),
+        branchvalues="total",
+        marker=dict(
+            colors=np.where(np.isnan(colors), None, colors),
+            colorscale=ICICLE_COLOR_SCHEMES.get(metric, "Blues"),
+            colorbar=dict(title=ICICLE_COLOR_LABELS.get(metric, metric)),
+            showscale=True
+        ),
+        **hover
+    ))
+    fig.update_layout(
+        title=f"Icicle Chart for: {result_set_name}",
+        margin=dict(t=40, l=0, r=0, b=0)
+    )
+    return fig
+
+def query_exploration_icicle(result_set_name, log_view, metric="avg_case_duration_seconds", show_time=False, details=True,
+                             split_mode="case_sets", show_memory=False, min_cases=1, max_depth=None, top_n=None, lazy=False,
+                             n_jobs=1, profile=None, headless=False, preview=False, sample_size=10_000, seed=0):
+    """
+    Icicle chart of every F/C branch along the lineage of a result set.
+
+    min_cases, max_depth and top_n prune the tree (see FilterTree). The
+    tree is built once per result set with every metric, so calling this
+    again with another metric only recolors the chart. With lazy=True a new
+    tree is built with only its first level computed and returned, so that
+    further nodes can be expanded and shown on demand.
+    n_jobs > 1 evaluates the lineage queries in a process pool.
+
+    Stage timings, evaluator calls and cache statistics are recorded in
+    profile (a Profile) when given; show_time and show_memory print them.
+
+    With headless=True nothing is shown or printed. Instead the node table
+    of the tree (FilterTree.to_nodes) and a go.Icicle figure built from it
+    are returned.
+
+    With preview=True the tree is built on a seeded, stratified sample of
+    sample_size cases and case counts and metrics are estimates with 95%
+    confidence intervals, shown in the hover text and the summary. A
+    Preview is returned; its refine() draws the exact chart.
+    """
+    if metric not in ALL_METRICS:
+        raise ValueError(f"Unsupported metric: {metric}")
+    if preview and lazy:
+        raise ValueError("preview cannot be combined with lazy.")
+    if profile is None:
+        profile = Profile(track_memory=show_memory)
+    elif show_memory:
+        profile.track_memory = True
+
+    with _profiled("query_exploration_icicle", profile):
+        # Get lineage
+        with profile.stage("lineage"):
+            lineage = get_query_catalog(log_view).lineage(result_set_name)
+
+        # Compute filtered subsets and stats
+        with profile.stage("apply_filters"):
+            if lazy:
+                tree = FilterTree(lineage, log_view, split_mode, min_cases, max_depth, top_n, n_jobs)
+                tree.expand()
+            elif preview:
+                tree = FilterTree(
+                    lineage, log_view, split_mode, min_cases, max_depth, top_n, n_jobs, sample_size, seed
+                ).expand_all()
+            else:
+                tree = get_filter_tree(lineage, log_view, split_mode, min_cases, max_depth, top_n, n_jobs)
+
+        with profile.stage("plot"):
+            if headless or preview:
+                nodes_df = tree.to_nodes()
+                title = f"{result_set_name} (preview of {tree.sample.sample_size:,} cases)" if preview else result_set_name
+                fig = _icicle_figure(nodes_df, metric, title)
+                if not headless:
+                    fig.show()
+                    if details:
+                        _print_icicle_summary(*tree.to_frame(metric), metric)
+            else:
+                icicle_df, main_path = tree.to_frame(metric)
+                _render_icicle(icicle_df, main_path, metric, result_set_name, details)
 
     if show_time:
-        print("\n--- Execution Time (seconds) ---")
-        for k, v in times.items():
-            print(f"{k:25}: {v:.4f}")
+        profile.report()
+
+    if show_memory:
+        print(f"\nPeak memory of the tree build: {profile.stage_peak_bytes['apply_filters'] / 1024 ** 2:.2f} MiB")
+
+    if preview:
+        def refine():
+            return query_exploration_icicle(
+                result_set_name, log_view, metric, show_time, details, split_mode, show_memory,
+                min_cases, max_depth, top_n, lazy, n_jobs, headless=headless
+            )
+        return Preview(tree.sample, nodes_df, fig, refine)
+    if headless:
+        return nodes_df, fig
+    if lazy:
+        return tree
+
+def lineage_trie(result_set_names, log_view):
+    """
+    Lineages of the given result sets merged into a trie of nested dicts,
+    from the first step's result set down to the given ones.
+    """
+    catalog = get_query_catalog(log_view)
+    trie = {}
+    for result_set_name in result_set_names:
+        level = trie
+        for step_result_set in catalog.lineage(result_set_name)["result_set"]:
+            level = level.setdefault(step_result_set, {})
+    return trie
+
+def build_filter_trees(result_set_names, log_view, split_mode="case_sets", min_cases=1, max_depth=None, top_n=None,
+                       n_jobs=1):
+    """
+    Fully expanded FilterTrees of several result sets, by result set name.
+
+    The lineages are merged into a trie and the trees built prefix first, so
+    every tree extends the cached tree of its parent result set (see
+    get_filter_tree) and each subset is split by each query only once. With
+    n_jobs > 1 all distinct queries are evaluated up front in one pool.
+    """
+    catalog = get_query_catalog(log_view)
+    trie = lineage_trie(result_set_names, log_view)
+
+    if n_jobs != 1 and split_mode == "case_sets":
+        queries_by_log = {}
+        for result_set_name in result_set_names:
+            lineage = catalog.lineage(result_set_name)
+            queries = queries_by_log.setdefault(lineage.iloc[0]["source_log"], {})
+            for _, row in lineage.iterrows():
+                query_obj = catalog.query_for(row)
+                queries[id(query_obj)] = query_obj
+        for source_log, queries in queries_by_log.items():
+            evaluate_case_codes_batch(
+                log_view, log_view.result_set_name_cache[source_log], list(queries.values()), n_jobs
+            )
+
+    trees = {}
+    stack = list(trie.items())
+    while stack:
+        result_set_name, children = stack.pop()
+        trees[result_set_name] = get_filter_tree(
+            catalog.lineage(result_set_name), log_view, split_mode, min_cases, max_depth, top_n
+        )
+        stack.extend(children.items())
+    return {result_set_name: trees[result_set_name] for result_set_name in result_set_names}
+
+def query_exploration_icicles(result_set_names, log_view, metric="avg_case_duration_seconds", details=True,
+                              split_mode="case_sets", min_cases=1, max_depth=None, top_n=None, n_jobs=1,
+                              profile=None, headless=False):
+    """
+    query_exploration_icicle for several result sets, sharing the work on
+    their common lineage prefixes (see build_filter_trees). Returns the
+    trees by result set, or with headless=True their node tables and
+    figures without showing anything.
+    """
+    if metric not in ALL_METRICS:
+        raise ValueError(f"Unsupported metric: {metric}")
+    if profile is None:
+        profile = Profile()
+
+    with _profiled("query_exploration_icicles", profile):
+        with profile.stage("apply_filters"):
+            trees = build_filter_trees(result_set_names, log_view, split_mode, min_cases, max_depth, top_n, n_jobs)
+
+        results = {}
+        with profile.stage("plot"):
+            for result_set_name, tree in trees.items():
+                if headless:
+                    nodes_df = tree.to_nodes()
+                    results[result_set_name] = (nodes_df, _icicle_figure(nodes_df, metric, result_set_name))
+                else:
+                    tree.show(metric, details)
+
+    return results if headless else trees
+
+# Background chart builds run one at a time. They take _cache_lock only to
+# look up and store cache entries, so calls from other threads are not held
+# up while a tree is built.
+_chart_executor = None
+
+class ChartJob:
+    """
+    Handle on a chart whose tree is built on a background thread. The latest
+    progress report is kept in progress; result() waits for the FilterTree
+    and cancel() stops the build before its next subset split. In asyncio
+    code a job can be awaited.
+    """
+
+    def __init__(self, build, on_progress=None):
+        global _chart_executor
+        if _chart_executor is None:
+            _chart_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="filter_visualization")
+
+        self.on_progress = on_progress
+        self.progress = None
+        self._cancel_event = threading.Event()
+        self.future = _chart_executor.submit(build, self)
+
+    def _report(self, step, num_steps, subsets_done, num_subsets):
+        self.progress = {
+            "step": step,
+            "num_steps": num_steps,
+            "subsets_done": subsets_done,
+            "num_subsets": num_subsets
+        }
+        if self.on_progress is not None:
+            self.on_progress(self.progress)
+
+    def cancel(self):
+        self._cancel_event.set()
+        self.future.cancel()
+
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def __await__(self):
+        import asyncio
+
+        return asyncio.wrap_future(self.future).__await__()
+
+def print_progress(progress):
+    """
+    on_progress callback that keeps one updating progress line.
+    """
+    end = "\n" if progress["step"] == progress["num_steps"] and progress["subsets_done"] == progress["num_subsets"] else ""
+    print(
+        f"\rStep {progress['step']}/{progress['num_steps']}: "
+        f"{progress['subsets_done']}/{progress['num_subsets']} subsets",
+        end=end, flush=True
+    )
+
+def query_exploration_icicle_async(result_set_name, log_view, metric="avg_case_duration_seconds", details=True,
+                                   split_mode="case_sets", min_cases=1, max_depth=None, top_n=None, n_jobs=1,
+                                   on_progress=print_progress, show=True, profile=None):
+    """
+    Non-blocking query_exploration_icicle: the tree is built on a worker
+    thread and the chart is shown once it is complete (unless show=False).
+    on_progress receives a progress dict after every subset split, pass
+    None to silence it. Returns a ChartJob whose result is the FilterTree.
+    """
+    if metric not in ALL_METRICS:
+        raise ValueError(f"Unsupported metric: {metric}")
+    if profile is None:
+        profile = Profile()
+
+    def build(job):
+        with _profiled("query_exploration_icicle_async", profile):
+            with profile.stage("lineage"):
+                lineage = get_query_catalog(log_view).lineage(result_set_name)
+
+            with profile.stage("apply_filters"):
+                tree = get_filter_tree(
+                    lineage, log_view, split_mode, min_cases, max_depth, top_n, n_jobs,
+                    progress=job._report, cancel_event=job._cancel_event
+                )
+
+            if show:
+                with profile.stage("plot"):
+                    tree.show(metric, details)
+        return tree
+
+    return ChartJob(build, on_progress)
 
 def get_sibling_subsets(result_set_name, log_view):
-    lineage_df = get_lineage(log_view.query_registry.summary(), result_set_name)
+    catalog = get_query_catalog(log_view)
+    lineage_df = catalog.lineage(result_set_name)
     if len(lineage_df) < 1:
         raise ValueError("Lineage not found.")
 
@@ -457,110 +2947,267 @@ def get_sibling_subsets(result_set_name, log_view):
     step_index = len(lineage_df) - 1
 
     # Lookup actual query object from registry
-    query_obj = None
-    for rs_id in log_view.query_registry.get_registered_result_set_ids():
-        evaluation = log_view.query_registry.get_evaluation(rs_id)
-        if evaluation["query"].name == query_name:
-            query_obj = evaluation["query"]
-            break
+    query_obj = catalog.query_for(last_query_row)
 
     if query_obj is None:
         raise ValueError(f"Query object for '{query_name}' not found.")
 
     return parent_log, query_obj, label, step_index, lineage_df
 
-def query_breakdown_pie(result_set_name, log_view, metric="avg_case_duration_seconds", details=True):
-    from plotly.colors import sample_colorscale
-    import plotly.graph_objects as go
+def query_breakdown_pie(result_set_name, log_view, metric="avg_case_duration_seconds", details=True, n_jobs=1,
+                        show_time=False, profile=None, headless=False, preview=False, sample_size=10_000, seed=0):
+    """
+    Pie chart of the cases passing the last query of a result set's lineage,
+    broken down by which earlier steps they pass. See
+    query_exploration_icicle for n_jobs, show_time, profile and preview.
+
+    With headless=True nothing is shown or printed. Instead the slice table
+    and the go.Pie figure are returned, or None when no case passes.
+    """
+    if profile is None:
+        profile = Profile()
+
+    sample = None
+    if preview:
+        sample = get_case_sample(_initial_source_log(log_view, result_set_name), sample_size, seed)
+
+    with _profiled("query_breakdown_pie", profile):
+        result = _query_breakdown_pie(result_set_name, log_view, metric, details, n_jobs, profile, headless, sample)
+
+    if show_time:
+        profile.report()
+
+    if preview:
+        def refine():
+            return query_breakdown_pie(
+                result_set_name, log_view, metric, details, n_jobs, show_time, headless=headless
+            )
+        grouped, fig = result if result is not None else (None, None)
+        return Preview(sample, grouped, fig, refine)
+    if headless:
+        return result
+
+def pie_case_set(result_set_name, log_view, path, n_jobs=1):
+    """
+    CaseSet of one slice of a result set's pie chart, given its path code or
+    path label (the path_code and path_label columns of the headless chart
+    data). The breakdown is the cached one, computed if needed.
+    """
+    _, grouped, case_slices = _pie_breakdown(result_set_name, log_view, n_jobs, Profile())
+    column = "path_label" if isinstance(path, str) else "path_code"
+    rows = np.flatnonzero(grouped[column].to_numpy() == path) if grouped is not None else []
+    if len(rows) == 0:
+        raise KeyError(path)
+
+    filtered, slice_index = case_slices
+    case_table = get_case_table(_initial_source_log(log_view, result_set_name))
+    return CaseSet(case_table, filtered[slice_index == rows[0]])
+
+def export_charts(result_set_names, log_view, directory, kind="icicle", file_format="html",
+                  metric="avg_case_duration_seconds", include_plotlyjs="cdn", **kwargs):
+    """
+    Compute the icicle or pie chart of every result set headlessly and write
+    each figure to <directory>/<result set>_<kind>.<html|json>, or with
+    file_format="csv" the chart data (tree nodes or pie slices) instead.
+    Extra keyword arguments go to the chart function. Returns the written paths by
+    result set; result sets without a pie chart are skipped.
+    """
+    if kind not in ("icicle", "pie"):
+        raise ValueError(f"Unsupported chart kind: {kind}")
+    if file_format not in ("html", "json", "csv"):
+        raise ValueError(f"Unsupported file format: {file_format}")
+    chart = query_exploration_icicle if kind == "icicle" else query_breakdown_pie
+
+    # Build the icicle trees together, so shared lineage prefixes are computed once
+    if kind == "icicle" and not kwargs.get("preview") and not kwargs.get("lazy"):
+        tree_options = ("split_mode", "min_cases", "max_depth", "top_n", "n_jobs")
+        build_filter_trees(result_set_names, log_view, **{key: kwargs[key] for key in tree_options if key in kwargs})
+
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for result_set_name in result_set_names:
+        result = chart(result_set_name, log_view, metric=metric, headless=True, **kwargs)
+        if result is None:
+            continue
 
-    def format_seconds(seconds):
-        seconds = int(seconds)
-        days, rem = divmod(seconds, 86400)
-        hours, rem = divmod(rem, 3600)
-        minutes = rem // 60
-        parts = []
-        if days: parts.append(f"{days}d")
-        if hours: parts.append(f"{hours}h")
-        if minutes: parts.append(f"{minutes}m")
-        return " ".join(parts) if parts else "0m"
+        data, fig = result
+        path = os.path.join(directory, f"{result_set_name}_{kind}.{file_format}")
+        if file_format == "csv":
+            data.to_csv(path, index=False)
+        elif file_format == "html":
+            fig.write_html(path, include_plotlyjs=include_plotlyjs, full_html=True)
+        else:
+            fig.write_json(path)
+        paths[result_set_name] = path
+    return paths
+
+# Pie breakdowns with every metric, keyed by id() of their log_view. They
+# refer to their log weakly, so replaced logs are not kept alive.
+_pie_breakdowns = {}
+
+def _pie_breakdown(result_set_name, log_view, n_jobs, profile, sample=None):
+    """
+    Final query, slice table (path code and label, case count and the mean
+    of every metric) and slice cases (case positions and their slice row)
+    of a result set's pie chart, cached per log_view. The table and cases
+    are None when no case passes the final query.
+
+    Given a CaseSample, the queries run on the sampled cases only and the
+    table holds estimates with confidence intervals; these are not cached.
+    """
+    full_log = _initial_source_log(log_view, result_set_name)
+    breakdowns = {}
+    if sample is not None:
+        full_log = sample.log_df
+    else:
+        lineage_steps = _lineage_steps(get_query_catalog(log_view).lineage(result_set_name), log_view)
+        case_metrics = get_case_metrics(full_log)
+        # The lock only guards the lookup, the breakdown is computed outside of it
+        with _cache_lock:
+            breakdowns = _get_attached(_pie_breakdowns, log_view)
+            if breakdowns is None:
+                breakdowns = _attach(_pie_breakdowns, log_view, {})
+            cached = breakdowns.get(result_set_name)
+        if (
+            cached is not None and cached[0]() is full_log and case_metrics is cached[1]
+            and _same_steps(lineage_steps, cached[2])
+        ):
+            _record_cache("pie_breakdowns", True)
+            return cached[3]
+        _record_cache("pie_breakdowns", False)
 
     # Get lineage and query
-    parent_log, query_obj, label, step_index, lineage_df = get_sibling_subsets(result_set_name, log_view)
+    with profile.stage("lineage"):
+        parent_log, query_obj, label, step_index, lineage_df = get_sibling_subsets(result_set_name, log_view)
+
+    with profile.stage("evaluate"):
+        # Get query expressions
+        catalog = get_query_catalog(log_view)
+
+        steps = []
+        for _, row in lineage_df.iterrows():
+            step_obj = catalog.query_for(row)
+            if step_obj:
+                steps.append((catalog.expression_for(row), step_obj))
+
+        # Evaluate every distinct query once on the full log
+        queries = list({id(q): q for q in [query_obj] + [step_obj for _, step_obj in steps]}.values())
+        query_case_codes = evaluate_case_codes_batch(log_view, full_log, queries, n_jobs)
+        case_metrics = get_case_metrics(full_log)
+
+        passing_by_query = {}
+        for q, case_codes in zip(queries, query_case_codes):
+            passing = np.zeros(len(case_metrics), dtype=bool)
+            passing[case_codes] = True
+            passing_by_query[id(q)] = passing
+
+        # Cases that pass the last query
+        filtered = np.flatnonzero(passing_by_query[id(query_obj)])
+
+    if len(filtered) == 0:
+        with _cache_lock:
+            breakdowns[result_set_name] = (weakref.ref(full_log), case_metrics, _lineage_steps(lineage_df, log_view),
+                                           (query_obj, None, None))
+        return query_obj, None, None
+
+    if len(steps) > 62:
+        raise ValueError("Lineages deeper than 62 steps cannot be broken down.")
+
+    with profile.stage("aggregate"):
+        # Pack the case x step pass/fail matrix into one integer per case. The
+        # first step is the most significant bit and a failed step sets its bit,
+        # so sorting the codes orders the slices like their path labels.
+        path_codes = np.zeros(len(filtered), dtype=np.int64)
+        for _, step_obj in steps:
+            path_codes = (path_codes << 1) | ~passing_by_query[id(step_obj)][filtered]
+
+        # Aggregate all metrics at once
+        unique_codes, slice_index = np.unique(path_codes, return_inverse=True)
+        values = case_metrics[list(METRIC_COLUMNS.values())].to_numpy(dtype=float)[filtered]
+        weights = None
+        if sample is not None:
+            strata = sample.strata_of(case_metrics.index)[filtered]
+            slice_stats = _sampled_group_stats(slice_index, len(unique_codes), strata, values, sample)
+            weights = (sample.stratum_sizes / sample.stratum_samples)[strata]
+        else:
+            slice_stats = {"num_cases": np.bincount(slice_index, minlength=len(unique_codes))}
+            for j, metric in enumerate(METRIC_COLUMNS):
+                slice_stats[metric] = _group_means(slice_index, values[:, j], len(unique_codes))[1]
+
+        # Quantile metrics from per-slice sketches
+        bins, first_bins, width = get_case_table(full_log).sketch_bins()
+        sketches = _group_sketches(slice_index, len(unique_codes), bins[filtered], width, weights)
+        slice_stats.update(_sketch_quantiles(sketches, first_bins))
+        if sample is not None:
+            slice_stats.update({f"{metric}_ci": np.full(len(unique_codes), np.nan) for metric in QUANTILE_METRICS})
+
+        # Render labels only for the slices that occur
+        def path_label(code):
+            return " → ".join(
+                f"{qexpr} ❌" if (code >> (len(steps) - 1 - j)) & 1 else f"{qexpr} ✅"
+                for j, (qexpr, _) in enumerate(steps)
+            )
+
+        grouped = pd.DataFrame({
+            "path_code": unique_codes,
+            "path_label": [path_label(code) for code in unique_codes],
+            **slice_stats
+        })
+
+        # Identify final result path
+        grouped["is_final"] = grouped["path_label"] == path_label(0)
+
+    # Cases of every slice, as positions in the case table with their slice row
+    case_slices = (filtered, slice_index)
+    with _cache_lock:
+        breakdowns[result_set_name] = (weakref.ref(full_log), case_metrics, _lineage_steps(lineage_df, log_view),
+                                       (query_obj, grouped, case_slices))
+    return query_obj, grouped, case_slices
+
+def _query_breakdown_pie(result_set_name, log_view, metric, details, n_jobs, profile, headless, sample=None):
+    from plotly.colors import sample_colorscale
+    import plotly.graph_objects as go
 
     # Metric setup
-    full_log = log_view.query_registry.get_initial_source_log()
     if metric == "avg_case_duration_seconds":
-        full_log = add_case_durations(full_log)
-        value_col = "case_duration"
         color_scheme = "Blues"
         color_title = "Avg Duration (s)"
     elif metric == "avg_events_per_case":
-        full_log = add_event_counts(full_log)
-        value_col = "num_events"
         color_scheme = "Reds"
         color_title = "Avg Events/Case"
     elif metric == "avg_time_between_events":
-        full_log = add_avg_time_between_events(full_log)
-        value_col = "avg_time_between_events"
         color_scheme = "Greens"
         color_title = "Avg Time Between Events (s)"
+    elif metric in QUANTILE_METRICS:
+        color_scheme = ICICLE_COLOR_SCHEMES[metric]
+        color_title = ICICLE_COLOR_LABELS[metric]
     else:
         raise ValueError("Unsupported metric")
 
-    # Evaluate last query
-    filtered, _ = log_view.query_evaluator.evaluate(full_log, query_obj)
-
-    if filtered.empty:
-        print("No cases passed the final filter, pie chart cannot be build.")
-        return
-
-    # Get query expressions
-    query_expr_map = {
-        ev["query"].name: ev["query"].as_string()
-        for rs_id in log_view.query_registry.get_registered_result_set_ids()
-        for ev in [log_view.query_registry.get_evaluation(rs_id)]
-    }
-
-    # Assign lineage path to cases
-    case_paths = {}
-    for _, row in lineage_df.iterrows():
-        qname = row["query"]
-        qexpr = query_expr_map.get(qname, qname)
-        step_obj = next(
-            (log_view.query_registry.get_evaluation(rs)["query"]
-             for rs in log_view.query_registry.get_registered_result_set_ids()
-             if log_view.query_registry.get_evaluation(rs)["query"].name == qname),
-            None
-        )
-        if step_obj:
-            passed_df, _ = log_view.query_evaluator.evaluate(full_log, step_obj)
-            passed_cases = set(passed_df["case:concept:name"])
-            for cid in filtered["case:concept:name"].unique():
-                case_paths.setdefault(cid, [])
-                case_paths[cid].append(f"{qexpr} ✅" if cid in passed_cases else f"{qexpr} ❌")
-
-    filtered = filtered.copy()
-    filtered["path_label"] = filtered["case:concept:name"].map(
-        lambda cid: " → ".join(case_paths.get(cid, []))
-    )
-
-    # Identify final result path
-    final_result_path = " → ".join([
-        f"{query_expr_map.get(row['query'], row['query'])} ✅"
-        for _, row in lineage_df.iterrows()
-    ])
+    query_obj, breakdown, _ = _pie_breakdown(result_set_name, log_view, n_jobs, profile, sample)
+    if breakdown is None:
+        if not headless:
+            print("No cases passed the final filter, pie chart cannot be build.")
+        return None
 
-
-    # Aggregate
-    grouped = (
-        filtered.groupby("path_label")[["case:concept:name", value_col]]
-        .agg(num_cases=("case:concept:name", "nunique"), avg_metric=(value_col, "mean"))
-        .reset_index()
-    )
+    grouped = breakdown[["path_code", "path_label", "num_cases", "is_final"]].copy()
+    grouped["avg_metric"] = breakdown[metric]
 
     # Add line breaks for hover display
     grouped["wrapped_path"] = grouped["path_label"].str.replace(" → ", " →<br>")
 
+    # Estimates of sampled previews, with their confidence intervals
+    title = f"Breakdown of Filter: {_query_expression(query_obj)}"
+    case_counts = format_counts(grouped["num_cases"])
+    metric_vals = format_metric_values(grouped["avg_metric"], metric, compact=True)
+    if sample is not None:
+        grouped["num_cases_ci"] = breakdown["num_cases_ci"]
+        grouped["avg_metric_ci"] = breakdown[f"{metric}_ci"]
+        case_counts = case_counts + format_margins(grouped["num_cases_ci"])
+        metric_vals = metric_vals + format_margins(grouped["avg_metric_ci"], metric)
+        grouped["wrapped_path"] += "<br>Cases: " + case_counts + f"<br>{color_title}: " + metric_vals
+        title += f" (preview of {sample.sample_size:,} cases)"
+
     # Normalize color
     min_val, max_val = grouped["avg_metric"].min(), grouped["avg_metric"].max()
     normed = (grouped["avg_metric"] - min_val) / (max_val - min_val + 1e-9)
@@ -568,62 +3215,388 @@ def query_breakdown_pie(result_set_name, log_view, metric="avg_case_duration_sec
 
     # Slice labels
     total_cases = grouped["num_cases"].sum()
-
-    def label_with_dot(row):
-        label = f"{int(row['num_cases']):,} cases ({row['num_cases'] / total_cases:.0%})"
-        return f"🟡 {label}" if row["path_label"] == final_result_path else label
-
-    grouped["slice_label"] = grouped.apply(label_with_dot, axis=1)
-
-    # Build chart
-    fig = go.Figure(
-        data=[go.Pie(
-            labels=grouped["slice_label"],
-            values=grouped["num_cases"],
-            textinfo="label",
-            customdata=grouped[["wrapped_path"]],
-            hovertemplate="<b>%{customdata[0]}</b><extra></extra>",
-            marker=dict(colors=color_values)
-        )],
-        layout=go.Layout(
-            title=dict(
-                text=f"Breakdown of Filter: {query_obj.as_string()}",
-                x=0.5
-            ),
-            width=800,
-            height=700,
-            showlegend=False,
-            paper_bgcolor='white',
-            plot_bgcolor='white',
-            xaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
-            yaxis=dict(showgrid=False, zeroline=False, showticklabels=False)
+    is_final = grouped["is_final"].to_numpy()
+    shares = format_percentages(grouped["num_cases"], total_cases, decimals=0)
+    slice_labels = format_counts(grouped["num_cases"]) + " cases (" + shares + ")"
+
+    grouped["slice_label"] = np.where(is_final, "🟡 " + slice_labels, slice_labels)
+
+    with profile.stage("plot"):
+        # Build chart
+        fig = go.Figure(
+            data=[go.Pie(
+                labels=grouped["slice_label"],
+                values=grouped["num_cases"],
+                textinfo="label",
+                customdata=grouped[["wrapped_path"]],
+                hovertemplate="<b>%{customdata[0]}</b><extra></extra>",
+                marker=dict(colors=color_values)
+            )],
+            layout=go.Layout(
+                title=dict(
+                    text=title,
+                    x=0.5
+                ),
+                width=800,
+                height=700,
+                showlegend=False,
+                paper_bgcolor='white',
+                plot_bgcolor='white',
+                xaxis=dict(showgrid=False, zeroline=False, showticklabels=False),
+                yaxis=dict(showgrid=False, zeroline=False, showticklabels=False)
+            )
         )
-    )
 
-    # Add colorbar
-    fig.add_trace(go.Scatter(
-        x=[None], y=[None], mode='markers',
-        marker=dict(
-            colorscale=color_scheme,
-            cmin=min_val,
-            cmax=max_val,
-            colorbar=dict(title=color_title, len=0.8, thickness=15),
-            color=[min_val],
-            showscale=True
-        ),
-        hoverinfo='none',
-        showlegend=False
-    ))
+        # Add colorbar
+        fig.add_trace(go.Scatter(
+            x=[None], y=[None], mode='markers',
+            marker=dict(
+                colorscale=color_scheme,
+                cmin=min_val,
+                cmax=max_val,
+                colorbar=dict(title=color_title, len=0.8, thickness=15),
+                color=[min_val],
+                showscale=True
+            ),
+            hoverinfo='none',
+            showlegend=False
+        ))
 
-    fig.show()
+        if headless:
+            return grouped, fig
+        fig.show()
 
     # Print textual summary
     if details:
         print("\nFilter Paths:\n")
-        for _, row in grouped.iterrows():
-            if "duration" in metric or "time" in metric:
-                time_str = format_seconds(row["avg_metric"])
-            else:
-                time_str = f"{row['avg_metric']:.2f}"
-            prefix = "🟡 " if row["path_label"] == final_result_path else ""
-            print(f"- {prefix}{int(row['num_cases']):,} cases ({row['num_cases'] / total_cases:.0%}): {row['path_label']} | {color_title}: {time_str}")
+        prefixes = np.where(is_final, "🟡 ", "").astype(object)
+        lines = (
+            "- " + prefixes + case_counts + " cases (" + shares + "): "
+            + grouped["path_label"].to_numpy(dtype=object) + f" | {color_title}: " + metric_vals
+        )
+        print("\n".join(lines))
+
+    return grouped, fig
+
+# Columns every log needs, whatever the queries
+LOG_COLUMNS = ["case:concept:name", "concept:name", "time:timestamp"]
+
+# Bumped whenever the layout of compiled logs changes
+COMPILED_LOG_VERSION = 1
+
+def query_spec_columns(query_spec):
+    """
+    Names possibly referring to log columns in a query specification (see
+    build_log_view): every string among the predicate arguments.
+    """
+    names = set()
+    stack = [
+        [*predicate_spec.get("args", []), *predicate_spec.get("kwargs", {}).values()]
+        for entry in query_spec["result_sets"] for predicate_spec in entry["predicates"]
+    ]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, str):
+            names.add(value)
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+    return names
+
+def _compact_column(series, categorical):
+    # Strings become categoricals with sorted categories, everything else is kept as read
+    if categorical and (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)):
+        return series.astype("category")
+    return series
+
+def _read_event_log(path, columns, chunksize, categorical, keys):
+    if path.endswith((".parquet", ".pq")):
+        import pyarrow.parquet as pq
+
+        available = pq.read_schema(path).names
+    else:
+        available = list(pd.read_csv(path, nrows=0).columns)
+    missing = [key for key in keys if key not in available]
+    if missing:
+        raise ValueError(f"{path} has no column {', '.join(missing)}, pass the case, activity and timestamp keys.")
+
+    # Columns named like a log column they are not mapped to would be duplicated by the renaming
+    usecols = [
+        col for col in available
+        if (columns is None or col in columns) and (col in keys or col not in keys.values())
+    ]
+    if path.endswith((".parquet", ".pq")):
+        chunks = [pd.read_parquet(path, columns=usecols)]
+    else:
+        chunks = pd.read_csv(path, usecols=usecols, chunksize=chunksize)
+    names = [keys.get(col, col) for col in usecols]
+
+    # Chunks are compacted as they are read, so the raw strings of only one chunk are held at a time
+    compacted = []
+    for chunk in chunks:
+        chunk = chunk.rename(columns=keys)
+        if not pd.api.types.is_datetime64_any_dtype(chunk["time:timestamp"]):
+            chunk["time:timestamp"] = pd.to_datetime(chunk["time:timestamp"], format="mixed")
+        chunk["time:timestamp"] = chunk["time:timestamp"].dt.as_unit("ns")
+        compacted.append(pd.DataFrame({col: _compact_column(chunk[col], categorical) for col in names}))
+
+    if len(compacted) == 1:
+        log_df = compacted[0]
+    else:
+        log_df = pd.DataFrame({
+            col: (
+                pd.Series(pd.api.types.union_categoricals([chunk[col] for chunk in compacted], sort_categories=True))
+                if all(isinstance(chunk[col].dtype, pd.CategoricalDtype) for chunk in compacted)
+                else pd.concat([chunk[col] for chunk in compacted], ignore_index=True)
+            )
+            for col in names
+        })
+    return log_df.reset_index(drop=True)
+
+def _store_compiled_log(directory, log_df, source=None):
+    """
+    Write a log as one .npy file per column and a meta.json describing
+    them and, if given, the source file they were read from. Categorical and string columns are stored as codes plus
+    categories, timestamp columns as int64 ticks. Written to a temporary directory that is
+    renamed into place, so readers never see a partial log.
+    """
+    tmp_directory = tempfile.mkdtemp(dir=os.path.dirname(directory), suffix=".tmp")
+    meta = {"version": COMPILED_LOG_VERSION, "num_rows": len(log_df), "source": source, "columns": []}
+    for i, (col, series) in enumerate(log_df.items()):
+        column = {"name": col, "file": f"{i}.npy"}
+        is_categorical = isinstance(series.dtype, pd.CategoricalDtype)
+        is_string = not is_categorical and (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series))
+        if is_string or is_categorical:
+            column["kind"] = "string" if is_string else "categorical"
+            column["categories"] = f"{i}.categories.npy"
+            series = series.astype("category")
+            np.save(os.path.join(tmp_directory, column["categories"]), series.cat.categories.to_numpy().astype(str))
+            values = series.cat.codes.to_numpy()
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            column["kind"] = "datetime"
+            column["unit"] = series.dt.unit
+            column["tz"] = None if series.dt.tz is None else str(series.dt.tz)
+            values = series.array.asi8
+        else:
+            column["kind"] = "numeric"
+            values = series.to_numpy(dtype=float if pd.api.types.is_extension_array_dtype(series) else None)
+        np.save(os.path.join(tmp_directory, column["file"]), values, allow_pickle=False)
+        meta["columns"].append(column)
+
+    with open(os.path.join(tmp_directory, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    try:
+        os.replace(tmp_directory, directory)
+    except OSError:
+        # Written by a concurrent session in the meantime
+        for name in os.listdir(tmp_directory):
+            os.remove(os.path.join(tmp_directory, name))
+        os.rmdir(tmp_directory)
+
+def _load_compiled_log(directory):
+    """
+    Log written by _store_compiled_log, with every column memory-mapped
+    read-only instead of read into memory. None when missing or outdated.
+    """
+    try:
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != COMPILED_LOG_VERSION:
+        return None
+    # Mark as recently used, see DiskCache.evict
+    os.utime(os.path.join(directory, "meta.json"))
+
+    columns = {}
+    for column in meta["columns"]:
+        # Plain array views of the mapping, pandas treats np.memmap as a distinct class
+        values = np.load(os.path.join(directory, column["file"]), mmap_mode="r").view(np.ndarray)
+        if column["kind"] in ("categorical", "string"):
+            categories = np.load(os.path.join(directory, column["categories"]), allow_pickle=False)
+            series = pd.Series(pd.Categorical.from_codes(values, categories=categories, validate=False), copy=False)
+            if column["kind"] == "string":
+                series = series.astype(object)
+        elif column["kind"] == "datetime":
+            series = pd.Series(values.view(f"datetime64[{column['unit']}]"), copy=False)
+            if column["tz"] is not None:
+                series = series.dt.tz_localize("UTC").dt.tz_convert(column["tz"])
+        else:
+            series = pd.Series(values, copy=False)
+        columns[column["name"]] = series
+    return pd.DataFrame(columns, copy=False)
+
+def _remove_superseded_logs(cache_dir, source):
+    # Compiled logs of earlier versions of the same file are never loaded again
+    for name in os.listdir(cache_dir):
+        directory = os.path.join(cache_dir, name)
+        if not name.startswith("log-") or not os.path.isdir(directory):
+            continue
+        try:
+            with open(os.path.join(directory, "meta.json")) as f:
+                held = json.load(f).get("source")
+        except (OSError, ValueError):
+            continue
+        if held is not None and held["path"] == source["path"] and (
+            held["size"] != source["size"] or held["mtime_ns"] != source["mtime_ns"]
+        ):
+            shutil.rmtree(directory, ignore_errors=True)
+
+def load_event_log(path, columns=None, chunksize=1_000_000, categorical=True, cache_dir=None,
+                   case_key="case:concept:name", activity_key="concept:name", timestamp_key="time:timestamp"):
+    """
+    Event log from a CSV or Parquet file (chosen by extension), with the
+    timestamp column parsed into nanosecond timestamps.
+
+    case_key, activity_key and timestamp_key name the case id, activity and
+    timestamp columns of the file (e.g. "case", "event" and "time"); they
+    are renamed to LOG_COLUMNS. columns limits the log to these columns plus
+    the key columns, e.g. to query_spec_columns() of the queries that will
+    run on it; names that are not columns of the file are ignored. CSV files
+    are read in chunks of chunksize rows. With categorical=True string
+    columns (case ids, activities, string attributes) become categoricals
+    with sorted categories.
+
+    With cache_dir set the loaded log is compiled there, as memory-mapped
+    column files keyed by the file's path, size, modification time and the
+    load options, and later loads map it instead of parsing the file again.
+    Compiled logs of earlier versions of the file are removed.
+    """
+    keys = dict(zip([case_key, activity_key, timestamp_key], LOG_COLUMNS))
+    if len(keys) < len(LOG_COLUMNS):
+        raise ValueError("The case, activity and timestamp keys must be distinct columns.")
+    if columns is not None:
+        columns = set(columns) | set(keys)
+
+    compiled_directory = None
+    if cache_dir is not None:
+        stat = os.stat(path)
+        source = {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        key = json.dumps([
+            source["path"], source["size"], source["mtime_ns"], None if columns is None else sorted(columns),
+            categorical, [case_key, activity_key, timestamp_key]
+        ])
+        compiled_directory = os.path.join(
+            cache_dir, f"log-{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}"
+        )
+        log_df = _load_compiled_log(compiled_directory)
+        _record_cache("compiled_log", log_df is not None)
+        if log_df is not None:
+            return log_df
+
+    log_df = _read_event_log(path, columns, chunksize, categorical, keys)
+    if compiled_directory is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        _remove_superseded_logs(cache_dir, source)
+        _store_compiled_log(compiled_directory, log_df, source)
+        compiled_log = _load_compiled_log(compiled_directory)
+        if compiled_log is not None:
+            # Continue on the mapped columns, so the parsed ones can be freed
+            log_df = compiled_log
+        if _disk_cache is not None and os.path.samefile(_disk_cache.directory, cache_dir):
+            _disk_cache.evict()
+    return log_df
+
+def build_log_view(log_df, query_spec):
+    """
+    Log view of a log with the result sets of a query specification
+    registered in order. The specification is a dict (e.g. loaded from
+    JSON) of the form
+
+        {"result_sets": [
+            {"name": "rs_GoodCredit", "query": "GoodCredit",
+             "predicates": [{"predicate": "GreaterEqualToConstant", "args": ["CreditScore", 600]}]},
+            {"name": "rs_Loan", "source": "rs_GoodCredit", "query": "LoanOverThreshold",
+             "predicates": [{"predicate": "GreaterEqualToConstant", "args": ["RequestedAmount", 10000]}]}
+        ]}
+
+    where predicates name logview.predicate classes and a result set without
+    a source is evaluated on the log itself.
+    """
+    from logview import predicate
+    from logview.utils import LogViewBuilder
+
+    log_view = LogViewBuilder.build_log_view(log_df)
+    result_sets = {}
+    for entry in query_spec["result_sets"]:
+        predicates = []
+        for predicate_spec in entry["predicates"]:
+            predicate_class = getattr(predicate, predicate_spec["predicate"], None)
+            if predicate_class is None:
+                raise ValueError(f"Unknown predicate: {predicate_spec['predicate']}")
+            predicates.append(predicate_class(*predicate_spec.get("args", []), **predicate_spec.get("kwargs", {})))
+
+        source = entry.get("source")
+        if source is not None and source not in result_sets:
+            raise ValueError(f"Result set {entry['name']} refers to unknown source {source}.")
+        source_df = log_df if source is None else result_sets[source]
+        query_obj = predicate.Query(entry.get("query", entry["name"]), predicates)
+        result_sets[entry["name"]], _ = log_view.evaluate_query(entry["name"], source_df, query_obj)
+    return log_view
+
+def main(argv=None):
+    """
+    Headless batch run: load a log and a query specification, build the
+    charts of the named result sets and write them to a directory, e.g.
+
+        python -m filter_visualization log.parquet queries.json out/ --format csv
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m filter_visualization",
+        description="Build filter trees for result sets of an event log and write them to disk."
+    )
+    parser.add_argument("log", help="event log as .csv or .parquet")
+    parser.add_argument("queries", help="query specification as JSON, see build_log_view")
+    parser.add_argument("output", help="directory the files are written to")
+    parser.add_argument("--result-set", action="append", dest="result_sets", metavar="NAME",
+                        help="result set to chart, repeatable (default: every result set of the specification)")
+    parser.add_argument("--kind", choices=("icicle", "pie"), default="icicle")
+    parser.add_argument("--format", choices=("csv", "html", "json"), default="csv", dest="file_format",
+                        help="csv writes the tree nodes or pie slices, html and json the figures")
+    parser.add_argument("--metric", choices=ALL_METRICS, default="avg_case_duration_seconds")
+    parser.add_argument("--split-mode", choices=("case_sets", "evaluate"), default="case_sets")
+    parser.add_argument("--min-cases", type=int, default=1)
+    parser.add_argument("--max-depth", type=int)
+    parser.add_argument("--top-n", type=int)
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument("--backend", choices=BACKENDS, default="pandas")
+    parser.add_argument("--native", action="store_true", help="use the native evaluator where possible")
+    parser.add_argument("--disk-cache", metavar="DIR",
+                        help="cache the compiled log, case metrics and query results in DIR")
+    parser.add_argument("--chunksize", type=int, default=1_000_000, help="rows per chunk when reading a CSV log")
+    parser.add_argument("--case-key", default="case:concept:name", help="case id column of the log")
+    parser.add_argument("--activity-key", default="concept:name", help="activity column of the log")
+    parser.add_argument("--timestamp-key", default="time:timestamp", help="timestamp column of the log")
+    parser.add_argument("--all-columns", action="store_true",
+                        help="keep every column of the log, not only the ones the queries refer to")
+    args = parser.parse_args(argv)
+
+    set_backend(args.backend)
+    set_native_evaluation(args.native)
+    if args.disk_cache:
+        set_disk_cache(args.disk_cache)
+
+    with open(args.queries) as f:
+        query_spec = json.load(f)
+    log_df = load_event_log(
+        args.log, columns=None if args.all_columns else query_spec_columns(query_spec), chunksize=args.chunksize,
+        cache_dir=args.disk_cache, case_key=args.case_key, activity_key=args.activity_key,
+        timestamp_key=args.timestamp_key
+    )
+    log_view = build_log_view(log_df, query_spec)
+    result_set_names = args.result_sets or [entry["name"] for entry in query_spec["result_sets"]]
+
+    kwargs = {"n_jobs": args.n_jobs}
+    if args.kind == "icicle":
+        kwargs.update(
+            split_mode=args.split_mode, min_cases=args.min_cases, max_depth=args.max_depth, top_n=args.top_n
+        )
+    paths = export_charts(
+        result_set_names, log_view, args.output, kind=args.kind, file_format=args.file_format, metric=args.metric,
+        **kwargs
+    )
+    for result_set_name in result_set_names:
+        print(f"{result_set_name}: {paths.get(result_set_name, 'no passing cases, skipped')}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+logview_predicate = pytest.importorskip("logview.predicate")
+logview_utils = pytest.importorskip("logview.utils")
+pytest.importorskip("plotly")
+
+import filter_visualization as fv
+
+Query = logview_predicate.Query
+RESULT_SETS = ["rs_Good", "rs_Loan", "rs_Start", "rs_End"]
+
+
+def make_log(num_cases=400, seed=0):
+    rng = np.random.default_rng(seed)
+    activities = ["A_Create Application", "A_Submitted", "W_Call", "A_Pending", "A_Denied"]
+    rows = []
+    for case in range(num_cases):
+        start = pd.Timestamp("2020-01-01") + pd.Timedelta(seconds=int(rng.integers(0, 10 ** 7)))
+        offsets = np.sort(rng.integers(0, 5 * 86400, rng.integers(1, 7)))
+        score, amount = float(rng.integers(300, 900)), int(rng.integers(1000, 30000))
+        for offset in offsets:
+            rows.append({
+                "case:concept:name": f"C{case}",
+                "concept:name": activities[rng.integers(0, len(activities))],
+                "time:timestamp": start + pd.Timedelta(seconds=int(offset - offsets[0])),
+                "CreditScore": score,
+                "RequestedAmount": amount
+            })
+    return pd.DataFrame(rows).sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def make_view(log_df):
+    log_view = logview_utils.LogViewBuilder.build_log_view(log_df)
+    good, _ = log_view.evaluate_query(
+        "rs_Good", log_df, Query("Good", [logview_predicate.GreaterEqualToConstant("CreditScore", 600)])
+    )
+    log_view.evaluate_query(
+        "rs_Loan", good, Query("Loan", [logview_predicate.GreaterEqualToConstant("RequestedAmount", 10000)])
+    )
+    start, _ = log_view.evaluate_query(
+        "rs_Start", log_df, Query("Start", [logview_predicate.StartWith(["A_Create Application"])])
+    )
+    log_view.evaluate_query("rs_End", start, Query("End", [logview_predicate.EndWith(["A_Pending", "A_Denied"])]))
+    return log_view
+
+
+def split_batch(log_df, seed=0):
+    # The last event of some known cases plus every event of some new cases
+    rng = np.random.default_rng(seed)
+    case_ids = log_df["case:concept:name"].unique()
+    new_cases = case_ids[-30:]
+    is_last = log_df.groupby("case:concept:name")["time:timestamp"].transform("max") == log_df["time:timestamp"]
+    late = log_df["case:concept:name"].isin(rng.choice(case_ids[:-30], 50, replace=False)) & is_last
+    in_batch = log_df["case:concept:name"].isin(new_cases) | late
+    return log_df[~in_batch].reset_index(drop=True), log_df[in_batch]
+
+
+def sorted_nodes(log_view, result_set_name):
+    nodes_df, _ = fv.query_exploration_icicle(result_set_name, log_view, headless=True)
+    return nodes_df.set_index("id").sort_index()
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    yield
+    fv.clear_caches()
+
+
+def test_append_matches_rebuild():
+    old_log, batch = split_batch(make_log())
+    log_view = make_view(old_log)
+    for result_set_name in RESULT_SETS:
+        fv.query_exploration_icicle(result_set_name, log_view, headless=True)
+        fv.query_breakdown_pie(result_set_name, log_view, headless=True)
+
+    new_log = fv.append_events(log_view, batch, "Initial Source Log")
+    rebuilt_view = make_view(new_log.copy())
+
+    pd.testing.assert_frame_equal(
+        fv.get_case_metrics(new_log).sort_index(), fv.compute_case_metrics(new_log), check_exact=False, rtol=1e-12
+    )
+    for result_set_name in RESULT_SETS:
+        pd.testing.assert_frame_equal(
+            sorted_nodes(log_view, result_set_name), sorted_nodes(rebuilt_view, result_set_name),
+            check_exact=False, rtol=1e-9
+        )
+        appended, _ = fv.query_breakdown_pie(result_set_name, log_view, headless=True)
+        rebuilt, _ = fv.query_breakdown_pie(result_set_name, rebuilt_view, headless=True)
+        pd.testing.assert_frame_equal(appended, rebuilt, check_exact=False, rtol=1e-9)
+
+
+def test_repeated_appends_match_rebuild():
+    log_df = make_log(seed=1)
+    old_log, batch = split_batch(log_df, seed=1)
+    log_view = make_view(old_log)
+    fv.query_exploration_icicle("rs_End", log_view, headless=True)
+
+    for part in np.array_split(np.arange(len(batch)), 3):
+        new_log = fv.append_events(log_view, batch.iloc[part], "Initial Source Log")
+
+    pd.testing.assert_frame_equal(
+        sorted_nodes(log_view, "rs_End"), sorted_nodes(make_view(new_log.copy()), "rs_End"),
+        check_exact=False, rtol=1e-9
+    )
@@ -0,0 +1,174 @@
+import gc
+import weakref
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import filter_visualization as fv
+
+
+def make_log(num_cases=200, seed=0):
+    rng = np.random.default_rng(seed)
+    activities = ["A_Create Application", "A_Submitted", "W_Call", "A_Pending", "A_Denied"]
+    rows = []
+    for case in range(num_cases):
+        start = pd.Timestamp("2020-01-01") + pd.Timedelta(seconds=int(rng.integers(0, 10 ** 7)))
+        offsets = np.sort(rng.integers(0, 5 * 86400, rng.integers(1, 7)))
+        score = float(rng.integers(300, 900))
+        for offset in offsets:
+            rows.append({
+                "case:concept:name": f"C{case}",
+                "concept:name": activities[rng.integers(0, len(activities))],
+                "time:timestamp": start + pd.Timedelta(seconds=int(offset - offsets[0])),
+                "CreditScore": score
+            })
+    return pd.DataFrame(rows).sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def test_cached_state_does_not_keep_the_log_alive():
+    log_df = make_log()
+    fv.get_event_store(log_df)
+    fv.get_case_sample(log_df, 50)
+    fv.log_fingerprint(log_df)
+    log_ref = weakref.ref(log_df)
+
+    del log_df
+    gc.collect()
+
+    assert log_ref() is None
+    assert not fv._case_tables and not fv._event_stores and not fv._case_metrics_cache
+
+
+def test_append_events_releases_replaced_logs():
+    logview_utils = pytest.importorskip("logview.utils")
+    log_df = make_log()
+    log_view = logview_utils.LogViewBuilder.build_log_view(log_df)
+    del log_df
+    fv.get_case_table(log_view.result_set_name_cache["Initial Source Log"])
+
+    replaced = []
+    for i in range(5):
+        new_events = make_log(3, seed=i + 1)
+        new_events["case:concept:name"] = new_events["case:concept:name"] + f"_{i}"
+        fv.append_events(log_view, new_events, "Initial Source Log")
+        replaced.append(weakref.ref(log_view.result_set_name_cache["Initial Source Log"]))
+    gc.collect()
+
+    # Every appended log but the current one is gone, the log_view may hold on to its initial log
+    assert [log_ref() is not None for log_ref in replaced] == [False] * 4 + [True]
+    assert len(fv._case_tables) <= 2
+    fv.clear_caches()
+
+
+def test_values_changed_in_place_without_copy_on_write_are_detected(monkeypatch):
+    # pandas 2 without copy-on-write lets column values change in place, mimicked by writing through a view
+    monkeypatch.setattr(fv, "_copy_on_write", lambda: False)
+    log_df = make_log()
+    case_metrics = fv.get_case_metrics(log_df)
+    fingerprint = fv.log_fingerprint(log_df)
+
+    timestamps = log_df["time:timestamp"].array._ndarray
+    timestamps.flags.writeable = True
+    timestamps[log_df["case:concept:name"].to_numpy() == "C0"] += np.timedelta64(1, "D")
+
+    assert fv.get_case_metrics(log_df) is not case_metrics
+    assert fv.log_fingerprint(log_df) != fingerprint
+    fv.clear_caches()
+
+
+def disk_cache_queries(logview_predicate):
+    return [
+        logview_predicate.Query("Good", [logview_predicate.GreaterEqualToConstant("CreditScore", 600)]),
+        logview_predicate.Query("Start", [logview_predicate.StartWith(["A_Create Application"])])
+    ]
+
+
+def test_warm_disk_cache_matches_cold(tmp_path, monkeypatch):
+    logview_predicate = pytest.importorskip("logview.predicate")
+    logview_utils = pytest.importorskip("logview.utils")
+    fv.set_disk_cache(str(tmp_path))
+    log_df = make_log()
+    queries = disk_cache_queries(logview_predicate)
+    log_view = logview_utils.LogViewBuilder.build_log_view(log_df)
+    cold_codes = fv.evaluate_case_codes_batch(log_view, log_df, queries)
+    cold_metrics = fv.get_case_metrics(log_df)
+    fv.clear_caches()
+
+    # A later session on an equal log answers from disk without evaluating anything
+    def fail(*args):
+        raise AssertionError("evaluated despite a warm disk cache")
+    monkeypatch.setattr(fv, "evaluate_query", fail)
+    monkeypatch.setattr(fv, "compute_case_metrics", fail)
+    warm_df = log_df.copy()
+    warm_view = logview_utils.LogViewBuilder.build_log_view(warm_df)
+    warm_codes = fv.evaluate_case_codes_batch(warm_view, warm_df, queries)
+
+    for case_codes, expected in zip(warm_codes, cold_codes):
+        np.testing.assert_array_equal(case_codes, expected)
+    pd.testing.assert_frame_equal(fv.get_case_metrics(warm_df), cold_metrics)
+    fv.set_disk_cache(None)
+    fv.clear_caches()
+
+
+def test_disk_cache_misses_after_an_in_place_edit(tmp_path):
+    logview_predicate = pytest.importorskip("logview.predicate")
+    logview_utils = pytest.importorskip("logview.utils")
+    fv.set_disk_cache(str(tmp_path))
+    log_df = make_log()
+    queries = disk_cache_queries(logview_predicate)
+    log_view = logview_utils.LogViewBuilder.build_log_view(log_df)
+    case_codes = fv.evaluate_case_codes_batch(log_view, log_df, queries)
+    case_metrics = fv.get_case_metrics(log_df)
+    fingerprint = fv.log_fingerprint(log_df)
+
+    first_cases = log_df["case:concept:name"].isin([f"C{case}" for case in range(20)])
+    log_df.loc[first_cases, "CreditScore"] = 950.0
+    log_df.loc[first_cases, "time:timestamp"] = pd.Timestamp("2020-01-01")
+    edited_codes = fv.evaluate_case_codes_batch(log_view, log_df, queries)
+    edited_metrics = fv.get_case_metrics(log_df)
+    fv.set_disk_cache(None)
+    fv.clear_caches()
+
+    assert fv.log_fingerprint(log_df) != fingerprint
+    assert len(edited_codes[0]) > len(case_codes[0])
+    assert not edited_metrics["case_duration"].equals(case_metrics["case_duration"])
+    for case_codes, expected in zip(edited_codes, fv.evaluate_case_codes_batch(log_view, log_df, queries)):
+        np.testing.assert_array_equal(case_codes, expected)
+    pd.testing.assert_frame_equal(edited_metrics, fv.compute_case_metrics(log_df))
+    fv.clear_caches()
+
+
+def test_session_cache_counts_hits_and_evicts_least_recently_used():
+    cache = fv.SessionCache(max_bytes=3 * 800)
+    for key in "abc":
+        cache.put(key, np.arange(100))
+    assert cache.get("a") is not None
+    cache.put("d", np.arange(100))
+
+    assert [key for key, _ in cache.items()] == ["c", "a", "d"]
+    assert cache.get("b") is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+    assert cache.num_bytes == 3 * 800
+
+    cache.put("e", np.arange(1000))
+    assert len(cache) == 3
+
+
+def test_warm_session_matches_cold(monkeypatch):
+    logview_predicate = pytest.importorskip("logview.predicate")
+    logview_utils = pytest.importorskip("logview.utils")
+    log_df = make_log()
+    queries = disk_cache_queries(logview_predicate)
+    log_view = logview_utils.LogViewBuilder.build_log_view(log_df)
+    cold_codes = fv.evaluate_case_codes_batch(log_view, log_df, queries)
+
+    def fail(*args):
+        raise AssertionError("evaluated despite a warm session cache")
+    monkeypatch.setattr(fv, "evaluate_query", fail)
+    warm_codes = fv.evaluate_case_codes_batch(log_view, log_df, queries)
+
+    for case_codes, expected in zip(warm_codes, cold_codes):
+        np.testing.assert_array_equal(case_codes, expected)
+    assert fv.get_session_cache(log_view).stats()["hits"] == len(queries)
+    fv.clear_caches()
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+logview_predicate = pytest.importorskip("logview.predicate")
+logview_utils = pytest.importorskip("logview.utils")
+pytest.importorskip("plotly")
+
+import filter_visualization as fv
+
+Query = logview_predicate.Query
+
+
+def make_log(num_cases=300, seed=0):
+    rng = np.random.default_rng(seed)
+    activities = ["A_Create Application", "A_Submitted", "W_Call", "A_Pending", "A_Denied"]
+    rows = []
+    for case in range(num_cases):
+        start = pd.Timestamp("2020-01-01") + pd.Timedelta(seconds=int(rng.integers(0, 10 ** 7)))
+        offsets = np.sort(rng.integers(0, 5 * 86400, rng.integers(1, 7)))
+        score = float(rng.integers(300, 900))
+        for offset in offsets:
+            rows.append({
+                "case:concept:name": f"C{case}",
+                "concept:name": activities[rng.integers(0, len(activities))],
+                "time:timestamp": start + pd.Timedelta(seconds=int(offset - offsets[0])),
+                "CreditScore": score
+            })
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture
+def log_view():
+    log_df = make_log()
+    log_view = logview_utils.LogViewBuilder.build_log_view(log_df)
+    good, _ = log_view.evaluate_query(
+        "rs_Good", log_df, Query("Good", [logview_predicate.GreaterEqualToConstant("CreditScore", 600)])
+    )
+    log_view.evaluate_query("rs_Start", good, Query("Start", [logview_predicate.StartWith(["A_Create Application"])]))
+    yield log_view
+    fv.clear_caches()
+
+
+def passing_cases(nodes_df, depth):
+    # Case count of the node passing the first depth steps; node ids number steps by registration
+    pattern = "Initial Source Log" + r"_F\d+" * depth
+    return nodes_df.loc[nodes_df["id"].str.fullmatch(pattern), "num_cases"].item()
+
+
+def test_exported_case_sets_chart_their_own_cases(log_view):
+    case_sets = {
+        "rs_Passing": fv.icicle_case_set("rs_Start", log_view, "Initial Source Log_F1_F2"),
+        "rs_Failing": fv.icicle_case_set("rs_Start", log_view, "Initial Source Log_F1_C2")
+    }
+    assert len(case_sets["rs_Passing"]) != len(case_sets["rs_Failing"])
+
+    for name, case_set in case_sets.items():
+        case_set.to_result_set(log_view, name)
+
+    for name, case_set in case_sets.items():
+        nodes_df, _ = fv.query_exploration_icicle(name, log_view, headless=True)
+        assert passing_cases(nodes_df, 1) == len(case_set)
+
+        grouped, _ = fv.query_breakdown_pie(name, log_view, headless=True)
+        assert grouped["num_cases"].tolist() == [len(case_set)]
+        assert grouped["path_label"].iloc[0].startswith(f"CaseSet {name}")
+
+        assert set(fv.pie_case_set(name, log_view, 0).case_ids()) == set(case_set.case_ids())
+
+
+def test_queries_on_exported_case_sets_see_only_their_cases(log_view):
+    case_set = fv.icicle_case_set("rs_Start", log_view, "Initial Source Log_F1_F2")
+    exported = case_set.to_result_set(log_view, "rs_Drill")
+    log_view.evaluate_query(
+        "rs_Drill_Low", exported, Query("Low", [logview_predicate.LessThanConstant("CreditScore", 700)])
+    )
+
+    nodes_df, _ = fv.query_exploration_icicle("rs_Drill_Low", log_view, headless=True, n_jobs=2)
+    low = case_set.metrics().index.isin(exported.loc[exported["CreditScore"] < 700, "case:concept:name"]).sum()
+    assert passing_cases(nodes_df, 1) == len(case_set)
+    assert passing_cases(nodes_df, 2) == low
+
+
+def test_registered_query_reproduces_the_set_in_logview(log_view):
+    case_set = fv.icicle_case_set("rs_Start", log_view, "Initial Source Log_F1_C2")
+    exported = case_set.to_result_set(log_view, "rs_Exported")
+    query_obj = log_view.query_registry.get_evaluation("rs_Exported")["query"]
+
+    log_df = log_view.result_set_name_cache["Initial Source Log"]
+    df_filtered, _ = log_view.query_evaluator.evaluate(log_df, query_obj)
+
+    assert set(df_filtered["case:concept:name"]) == set(case_set.case_ids())
+    assert len(df_filtered) == len(exported)
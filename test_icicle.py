@@ -0,0 +1,51 @@
+import pandas as pd
+import pytest
+
+import filter_visualization as fv
+
+
+def test_branch_totals_never_exceed_their_parent():
+    # Separately rounded estimates of a sampled preview: 10.6 + 32.6 rounds to 44, the parent to 43
+    nodes_df = pd.DataFrame({
+        "id": ["Log", "Log_F1", "Log_F1_F2", "Log_F1_C2", "Log_C1"],
+        "parent": ["", "Log", "Log_F1", "Log_F1", "Log"],
+        "num_cases": [60.4, 43.2, 10.6, 32.6, 17.2]
+    })
+
+    totals = dict(zip(nodes_df["id"], fv._branch_totals(nodes_df)))
+
+    assert totals == {"Log": 61, "Log_F1": 44, "Log_F1_F2": 11, "Log_F1_C2": 33, "Log_C1": 17}
+
+
+def test_format_counts_rounds_estimates():
+    assert list(fv.format_counts([1234.6, 2.4, 7])) == ["1,235", "2", "7"]
+
+
+def test_labels_follow_the_query_of_each_step_when_names_repeat():
+    logview_predicate = pytest.importorskip("logview.predicate")
+    logview_utils = pytest.importorskip("logview.utils")
+    log_df = pd.DataFrame({
+        "case:concept:name": ["C1", "C1", "C2", "C3"],
+        "concept:name": ["A_Create Application", "A_Pending", "A_Submitted", "A_Create Application"],
+        "time:timestamp": pd.to_datetime(["2020-01-01", "2020-01-02", "2020-01-01", "2020-01-03"]),
+        "CreditScore": [700.0, 700.0, 650.0, 400.0]
+    })
+    log_view = logview_utils.LogViewBuilder.build_log_view(log_df)
+    good, _ = log_view.evaluate_query(
+        "rs_A", log_df, logview_predicate.Query("Q", [logview_predicate.GreaterEqualToConstant("CreditScore", 600)])
+    )
+    log_view.evaluate_query(
+        "rs_B", good, logview_predicate.Query("Q", [logview_predicate.StartWith(["A_Create Application"])])
+    )
+    credit, start = (
+        fv.normalize_query_expression(query_obj)
+        for query_obj in fv.get_query_catalog(log_view).result_set_queries.values()
+    )
+
+    nodes_df, _ = fv.query_exploration_icicle("rs_B", log_view, headless=True)
+    grouped, _ = fv.query_breakdown_pie("rs_B", log_view, headless=True)
+
+    assert nodes_df.loc[nodes_df["id"].str.count("_") == 1, "label"].str.contains(credit, regex=False).all()
+    assert nodes_df.loc[nodes_df["id"].str.count("_") == 2, "label"].str.contains(start, regex=False).all()
+    assert grouped["path_label"].str.startswith(credit).all()
+    fv.clear_caches()
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+logview_predicate = pytest.importorskip("logview.predicate")
+logview_utils = pytest.importorskip("logview.utils")
+
+import filter_visualization as fv
+
+Query = logview_predicate.Query
+
+
+def make_log(num_cases=200, seed=0):
+    # Random cases with a numeric and a text attribute that are often missing
+    rng = np.random.default_rng(seed)
+    activities = ["A_Create Application", "A_Submitted", "W_Call", "A_Pending", "A_Denied"]
+    rows = []
+    for case in range(num_cases):
+        start = pd.Timestamp("2020-01-01") + pd.Timedelta(seconds=int(rng.integers(0, 10 ** 7)))
+        offsets = np.sort(rng.integers(0, 5 * 86400, rng.integers(1, 7)))
+        for offset in offsets:
+            rows.append({
+                "case:concept:name": f"C{case}",
+                "concept:name": activities[rng.integers(0, len(activities))],
+                "time:timestamp": start + pd.Timedelta(seconds=int(offset - offsets[0])),
+                "CreditScore": float(rng.integers(300, 900)) if rng.random() < 0.5 else np.nan,
+                "ApplicationType": rng.choice(["New credit", "Limit raise"]) if rng.random() < 0.7 else None
+            })
+    return pd.DataFrame(rows)
+
+
+PREDICATES = [
+    ("EqToConstant", ("ApplicationType", "New credit")),
+    ("NotEqToConstant", ("ApplicationType", "New credit")),
+    ("EqToConstant", ("CreditScore", 600.0)),
+    ("NotEqToConstant", ("CreditScore", 600.0)),
+    ("GreaterEqualToConstant", ("CreditScore", 600)),
+    ("GreaterThanConstant", ("CreditScore", 600)),
+    ("LessEqualToConstant", ("CreditScore", 600)),
+    ("LessThanConstant", ("CreditScore", 600)),
+    ("StartWith", (["A_Create Application"],)),
+    ("EndWith", (["A_Pending", "A_Denied"],)),
+    ("DurationWithin", (86400, 3 * 86400)),
+]
+
+
+@pytest.fixture(params=[False, True], ids=["object", "categorical"])
+def log_df(request):
+    log_df = make_log()
+    if request.param:
+        for column in ("concept:name", "ApplicationType"):
+            log_df[column] = log_df[column].astype("category")
+    return log_df
+
+
+@pytest.mark.parametrize("kind,args", PREDICATES, ids=[f"{kind}{args}" for kind, args in PREDICATES])
+def test_native_matches_query_evaluator(log_df, kind, args):
+    predicate_class = getattr(logview_predicate, kind, None)
+    if predicate_class is None:
+        pytest.skip(f"{kind} is not available in this logview version")
+    query_obj = Query(kind, [predicate_class(*args)])
+    log_view = logview_utils.LogViewBuilder.build_log_view(log_df)
+    case_metrics = fv.get_case_metrics(log_df)
+
+    native = fv._native_case_codes(log_df, query_obj, case_metrics)
+    df_filtered, _ = log_view.query_evaluator.evaluate(log_df, query_obj)
+    expected = np.sort(case_metrics.index.get_indexer(pd.unique(df_filtered["case:concept:name"])))
+
+    assert native is not None
+    np.testing.assert_array_equal(native, expected)
+
+
+def test_not_eq_keeps_cases_with_only_missing_values():
+    log_df = pd.DataFrame({
+        "case:concept:name": ["C1", "C1", "C2", "C2", "C3"],
+        "concept:name": ["A", "B", "A", "B", "A"],
+        "time:timestamp": pd.to_datetime(["2020-01-01", "2020-01-02", "2020-01-01", "2020-01-03", "2020-01-01"]),
+        "ApplicationType": ["New credit", "Limit raise", "Limit raise", None, None]
+    })
+    query_obj = Query("NotNew", [logview_predicate.NotEqToConstant("ApplicationType", "New credit")])
+    case_metrics = fv.get_case_metrics(log_df)
+
+    native = fv._native_case_codes(log_df, query_obj, case_metrics)
+
+    assert list(case_metrics.index[native]) == ["C2", "C3"]
+
+
+def test_duration_within_rejects_cases_without_valid_timestamps():
+    log_df = pd.DataFrame({
+        "case:concept:name": ["C1", "C1", "C2", "C2", "C3", "C3"],
+        "concept:name": ["A", "B", "A", "B", "A", "B"],
+        "time:timestamp": pd.to_datetime(["2020-01-01", "2020-01-02", None, None, "2020-01-01", None])
+    })
+    query_obj = Query("Short", [logview_predicate.DurationWithin(0, 2 * 86400)])
+    log_view = logview_utils.LogViewBuilder.build_log_view(log_df)
+    case_metrics = fv.get_case_metrics(log_df)
+
+    native = fv._native_case_codes(log_df, query_obj, case_metrics)
+    df_filtered, _ = log_view.query_evaluator.evaluate(log_df, query_obj)
+
+    assert list(case_metrics.index[native]) == ["C1", "C3"]
+    assert set(case_metrics.index[native]) == set(df_filtered["case:concept:name"])
+
+
+def test_predicates_without_logview_fields_fall_back_to_the_query_evaluator():
+    class DurationWithin(logview_predicate.DurationWithin):
+        # Same kind as logview's, but with its bounds under other names
+        def __init__(self, low, high):
+            self.low, self.high = low, high
+
+        def case_ids(self, df):
+            return logview_predicate.DurationWithin(self.low, self.high).case_ids(df)
+
+        def as_string(self):
+            return f"(Within {self.low} {self.high})"
+
+    log_df = make_log()
+    query_obj = Query("Short", [DurationWithin(0, 86400)])
+    log_view = logview_utils.LogViewBuilder.build_log_view(log_df)
+    case_metrics = fv.get_case_metrics(log_df)
+
+    assert fv._native_case_codes(log_df, query_obj, case_metrics) is None
+    case_codes = fv.evaluate_case_codes(log_view, log_df, query_obj, case_metrics)
+    np.testing.assert_array_equal(case_codes, np.flatnonzero(case_metrics["case_duration"].to_numpy() <= 86400))
+
+
+@pytest.fixture(autouse=True)
+def native_evaluation():
+    fv.set_native_evaluation(True)
+    yield
+    fv.set_native_evaluation(False)
+    fv.clear_caches()
@@ -0,0 +1,91 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+logview_predicate = pytest.importorskip("logview.predicate")
+logview_utils = pytest.importorskip("logview.utils")
+
+import filter_visualization as fv
+
+Query = logview_predicate.Query
+QUERIES = [
+    Query("Good", [logview_predicate.GreaterEqualToConstant("CreditScore", 600)]),
+    Query("Start", [logview_predicate.StartWith(["A_Create Application"])]),
+    Query("End", [logview_predicate.EndWith(["A_Pending", "A_Denied"])]),
+    Query("Nothing", [logview_predicate.GreaterThanConstant("CreditScore", 10000)])
+]
+
+
+def make_log(num_cases=300, seed=0):
+    rng = np.random.default_rng(seed)
+    activities = ["A_Create Application", "A_Submitted", "W_Call", "A_Pending", "A_Denied"]
+    rows = []
+    for case in range(num_cases):
+        start = pd.Timestamp("2020-01-01") + pd.Timedelta(seconds=int(rng.integers(0, 10 ** 7)))
+        offsets = np.sort(rng.integers(0, 5 * 86400, rng.integers(1, 7)))
+        score = float(rng.integers(300, 900))
+        for offset in offsets:
+            rows.append({
+                "case:concept:name": f"C{case}",
+                "concept:name": activities[rng.integers(0, len(activities))],
+                "time:timestamp": start + pd.Timedelta(seconds=int(offset - offsets[0])),
+                "CreditScore": score
+            })
+    return pd.DataFrame(rows).sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def serial_results(log_df):
+    log_view = logview_utils.LogViewBuilder.build_log_view(log_df)
+    case_codes = fv.evaluate_case_codes_batch(log_view, log_df, QUERIES)
+    case_metrics = fv.compute_case_metrics(log_df)
+    fv.clear_caches()
+    return case_codes, case_metrics
+
+
+def sharded_results(log_df, n_jobs):
+    log_view = logview_utils.LogViewBuilder.build_log_view(log_df)
+    case_codes = fv.evaluate_case_codes_batch(log_view, log_df, QUERIES, n_jobs=n_jobs)
+    return case_codes, fv.get_case_metrics(log_df)
+
+
+def assert_same(sharded, serial):
+    for case_codes, expected in zip(sharded[0], serial[0]):
+        np.testing.assert_array_equal(case_codes, expected)
+    pd.testing.assert_frame_equal(sharded[1], serial[1], check_exact=False, rtol=1e-12)
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    fv.clear_caches()
+    yield
+    fv.clear_caches()
+
+
+@pytest.mark.parametrize("n_jobs", [2, 3])
+def test_sharded_matches_serial(n_jobs):
+    log_df = make_log()
+    serial = serial_results(log_df)
+
+    assert_same(sharded_results(log_df, n_jobs), serial)
+
+
+def test_sharded_matches_serial_with_known_case_metrics():
+    log_df = make_log(seed=1)
+    serial = serial_results(log_df)
+    fv.get_case_metrics(log_df)
+
+    assert_same(sharded_results(log_df, 2), serial)
+
+
+def test_sharded_matches_serial_off_the_main_thread():
+    # Workers do not fork from other threads, they get the log pickled instead
+    log_df = make_log(seed=2)
+    serial = serial_results(log_df)
+    sharded = []
+    thread = threading.Thread(target=lambda: sharded.append(sharded_results(log_df, 2)))
+    thread.start()
+    thread.join()
+
+    assert_same(sharded[0], serial)